@@ -1,7 +1,20 @@
 # %%
-import pandas as pd 
+import os
+
 import streamlit as st 
-import plotly.express as px 
+
+import charts
+import comparables
+import data_viewer
+import data_views
+import figure_cache
+import incremental
+import instrumentation
+import market_cube
+import page_charts
+import query_service
+import sections
+import vehicle_data
 
 
 
@@ -28,81 +41,53 @@ import plotly.express as px
 # - At least one Plotly Express scatter plot using st.write (https://docs.streamlit.io/library/api-reference/write-magic/st.write) or st.plotly_chart (https://docs.streamlit.io/library/api-reference/charts/st.scatter_chart)
 # - At least one checkbox using st.checkbox that changes the behavior of any of the above components (https://docs.streamlit.io/library/api-reference/widgets/st.checkbox)
 
-# %%
-#read in data
-
-data = pd.read_csv('vehicles_us.csv')
-
-
-# %% [markdown]
-# # The data is arranged nicely so no need to restructure anything at this time. We will go ahead and add a column for manufacturer sine we'll want that information for our user interface.
-
-# %%
-# create a new column for manufacturer
-
-data['manufacturer'] = data['model'].apply(lambda x: x.split()[0])
-
-
 # %% [markdown]
-# # Now we will check our data set for any duplicated rows
+# # The cleaning steps from our notebook (manufacturer column, fillna and the group median fills) live in vehicle_data.py. Streamlit reruns this script on every widget click, so we cache the cleaned data once per version of the CSV and share the same copy between every rerun and every user. Because it is shared, the app never changes it: filters pick out row positions (see selection.py) and only the rows and columns a table or chart needs are copied. The page asks for what it shows through the queries in query_service.py, so when several app processes serve the page they can share one query service holding the listings instead of each loading its own copy (set QUERY_SERVICE to the socket of `python -m query_service`). When new listings are appended to vehicles_us.csv, only those are cleaned and added to the data; any other change rebuilds it. The cleaned data is also saved to vehicles_us.parquet, so a fresh worker can skip the cleaning steps until the CSV changes. Parts of the page that only need a few columns declare them as a view (see data_views.py) and copy just those columns, and just the rows they show, out of the shared data.
 
 # %%
-# checking for duplicate rows. Results show no duplicated rows in the dataframe
-
-data.duplicated()
-
-# %% [markdown]
-# # Beautiful, there are no duplicated rows.
-
-# %% [markdown]
-# # Now we'll check our data for missing values 
-
-
-# %% [markdown]
-# # We will fill in the missing values for each column using fillna and transform methods.
-
-# %%
-#fill in missing values using fillna
-
-data['price'] = data['price'].fillna(0)
-data['paint_color'] = data['paint_color'].fillna('unknown')
-data['is_4wd'] = data['is_4wd'].fillna(0)
-
-# %% [markdown]
-# # Now to use the transform method to group the data by relevant columns and find appropriate ways to fill in the missing values
-
-# %%
-# fill cylinders column by grouping cylinders and type and filling in the missing values with the median vlaue
-
-data['cylinders'] = data[['cylinders', 'type']].groupby('type').transform(lambda x: x.fillna(x.median()))
-
-# For missing values in model_year, we will group it with the model column and find the median range
-data['model_year'] = data[['model_year', 'model']].groupby('model').transform(lambda x: x.fillna(x.median()))
-
-# For the odometer column, we will group by the model and model_year columns to get the median of the odometer readings and fill in the missing values
-data ['odometer'] = data.groupby(['model_year', 'model'])['odometer'].transform(lambda x: x.fillna(x.median()))
-
-# %% [markdown]
-# # Let's check our dataframe to be sure that all of our missing values have been filled.
-
-# %%
-# check the number and percentage of missing values in the dataset
-
-# %% [markdown]
-# # Wonderful! Our columns no longer have missing data
-
-# %%
-# Checking the data shape to ensure it has the number of columns and rows as expected and it does.
-
-
-# %% [markdown]
-# # The model_year column has ',' which is not how we typically write out a year. I will change the column data from a float to integer to see if that can eliminate that issue. 
-
-# %%
-#convert model_year column from float to int
-
-data['model_year'] = data['model_year'].astype(int)
-
+#read in and clean data
+
+# the listings, the search and sort indexes, the summary of the listings and the comparable listings trees are built once and shared. When new listings are appended to the CSV, only those are cleaned and added to what was built (see incremental.py); any other change to the CSV builds everything again
+@st.cache_resource
+def load_feed():
+    return incremental.ListingFeed(vehicle_data.DATA_PATH)
+
+# the queries are answered by the query service when QUERY_SERVICE names its socket, over connections shared by every session of this process, and otherwise from the listings loaded here
+@st.cache_resource
+def load_queries():
+    address = os.environ.get(query_service.ADDRESS_VARIABLE)
+    if address:
+        return query_service.QueryClient(address, query_service.environment_key())
+    return query_service.QueryService(load_feed())
+
+# the parts of the page that only need a few columns copy just those (and only the rows they show) out of the shared listings
+MILEAGE_VIEW = data_views.View(['price', 'odometer', 'model_year'])
+NEW_LISTINGS = ('days_listed', '<=', market_cube.NEW_LISTING_DAYS)
+
+# charts are cached for every user by the dataset version and the widget values they depend on, and dropped when the listings change
+@st.cache_resource
+def load_figure_cache():
+    return figure_cache.FigureCache()
+
+# with CHART_WORKERS set, the charts of a rerun are built at the same time on a thread pool shared by every user and drawn in page order at the end of the script (see page_charts.py); otherwise each is built and drawn where it is on the page
+@st.cache_resource
+def load_chart_pool():
+    return page_charts.make_pool(page_charts.environment_workers())
+
+# every rerun is timed section by section, along with the size of every table and chart sent (see instrumentation.py). The timings are logged as JSON lines (to the file named by TIMINGS_LOG, or stderr) and kept for a p50/p95/p99 summary, which is shown in the sidebar when the address ends in ?debug=timings
+@st.cache_resource
+def load_recorder():
+    instrumentation.log_to(os.environ.get('TIMINGS_LOG'))
+    return instrumentation.Recorder()
+
+instrumentation.start(load_recorder())
+instrumentation.section('load listings')
+with st.spinner('Loading vehicle listings...'):
+    queries = load_queries().current()
+    fingerprint = queries.fingerprint()
+figures = load_figure_cache()
+figures.use_version(fingerprint)
+page = page_charts.PageCharts(load_chart_pool())
 
 
 # %% [markdown]
@@ -114,19 +99,20 @@ data['model_year'] = data['model_year'].astype(int)
 # %%
 #Create header
 
+instrumentation.section('data viewer')
 st.header('Pre-Owned Vehicle Market')
 
 # %% [markdown]
-# # Next we'll create a scrollable dataframe to view our entire dataframe on the web app. 
+# # Next we'll create a table to view our entire dataframe on the web app. The table shows one page at a time and is sorted on the server (see data_viewer.py), so we never send the whole inventory to the browser. 
 
 # %%
 # Create title for what we are looking at
 
 st.header('Data Viewer (shows all vehicles currently on the market)')
 
-# Embed dataframe using streamlit
+# Embed paged table using streamlit
 
-st.dataframe(data)
+data_viewer.show_table(queries, fingerprint, key='viewer')
 
 # %% [markdown]
 # # Now we'll incorporate user friendly interactive modules so that they can explore and compare pricing of the used vehicle market. 
@@ -137,6 +123,7 @@ st.dataframe(data)
 
 # %%
 # Create header and brief description that tells user what to do next
+instrumentation.section('new listings')
 st.header('Pre-Owned Vehicle Search')
 st.write(""" 
          #### Use the interactive models below to search the inventory for your specific wants and needs. Based on your search criteria, you can compare prices of different vehicle listings by their condition, mileage, type, and manufacturer. If you want to view and compare vehicles listed in the past 30 days, select the checkbox below. The results and price charts will only show inventory listed in the last 30 days.   
@@ -149,13 +136,20 @@ show_new_ads = st.checkbox('Show vehicles listed in last 30 days')
 
 
 # %% [markdown]
-# # Now to apply the filter for the check box. This will ensure that if this box is selected, all the data on the web app will be filtered to just vehicles listed in the past 30 days.
-
-# %%
-# Create filter for checkbox
+# # Streamlit runs this whole script again after every click. To keep that cheap, the work below is reused whenever the inputs it depends on have not changed. sections.run keeps the last result of a section for this user:
+# - search options: 30 day checkbox
+# - search table: 30 day checkbox, vehicle type, price range, and the table's own sort, page and column widgets (the data viewer table likewise, on its widgets)
+#
+# # The charts are kept in the figure cache that every user shares, under the inputs they depend on:
+# - price comparison: 30 day checkbox, histogram choice
+# - best value: 30 day checkbox, manufacturer, age
+# - days listed and mileage: 30 day checkbox
+#
+# # The search options of every drop down are asked for in one batch, a single round trip to the query service when there is one.
+# # The histograms, the box plot and the drop down choices are read from the market cube (market_cube.py), a summary of the listings grouped by manufacturer, type, condition, age and listing age. The scatter plot needs the mileage of every listing, so it still reads the rows.
 
-if show_new_ads:
-    data = data[data.days_listed <= 30]
+# %% [markdown]
+# # Now to apply the filter for the check box. This will ensure that if this box is selected, all the data on the web app will be filtered to just vehicles listed in the past 30 days: every query below is passed new_only=show_new_ads.
 
 
 # %% [markdown]
@@ -165,9 +159,21 @@ if show_new_ads:
 # # First we'll create a filter for users to search vehicles by the vehicle type. (SUV, sedan, truck, coupe, bus, etc.)
 
 # %%
-# Take a look at vehicle 'type' column and all of its unique values.
+# Take a look at vehicle 'type' column and all of its unique values, and the lowest and highest prices for the price slider below.
+
+instrumentation.section('search options')
 
-vehicle_type = data['type'].unique()
+def search_options():
+    with queries.batch() as batch:
+        types = batch.domain('type', new_only=show_new_ads)
+        prices = batch.value_range(new_only=show_new_ads)
+        manufacturers = batch.domain('manufacturer', new_only=show_new_ads)
+        ages = batch.domain('age_category', new_only=show_new_ads)
+        models = batch.models()
+    lowest, highest = prices.result()
+    return types.result(), int(lowest), int(highest), manufacturers.result(), ages.result(), models.result()
+
+vehicle_type, min_price, max_price, vehicle_man, age_choice, comp_models = sections.run('search options', (fingerprint, show_new_ads), search_options)
 
 # Use streamlit to embed a dropdown box for users to select a type of vehicle to search for.
 type_choice = st.selectbox('Select vehicle type:', vehicle_type)
@@ -178,9 +184,7 @@ type_choice = st.selectbox('Select vehicle type:', vehicle_type)
 # # Now that the user has selected a vehicle type they are searching for, we will let them narrow it down even further by price range they want to search in. To do this, I am going to use a slider bar to select the price range.
 
 # %%
-# first we'll create minimum and maximum price points for our data by creating new variables using the min() and max() methods.
-
-min_price, max_price = int(data['price'].min()), int(data['price'].max())
+# the minimum and maximum price points for our data were found with the vehicle types above.
 
 #Next we'll create the slider with streamlit. 
 
@@ -193,12 +197,10 @@ price_range = st.slider(
 
 # %%
 # Filter the dataset based on the users chosen variables
-filtered_table = data[(data.type==type_choice) & (data.price>=price_range[0]) & (data.price <= price_range[1])]
-
-
+instrumentation.section('search table')
 
 #show the final table in streamlit
-st.dataframe(filtered_table)
+data_viewer.show_table(queries, fingerprint, key='search', new_only=show_new_ads, equals={'type': type_choice}, ranges={'price': price_range})
 
 # %% [markdown]
 # ## The filtered search features are complete. Now the user can see what inventory is available for their specific wants. The user can stop here or if they want to compare prices and find the best value they can continue below. 
@@ -212,6 +214,7 @@ st.dataframe(filtered_table)
 
 # %%
 # Create title/header for section using Streamlit. 
+instrumentation.section('price comparison')
 st.header('Price Comparison')
 st.write(""" 
          #### Let's see how different factors can influence the price of a vehicle. Select an option below to see the price distribution based on manufacturer, type of vehicle, and condition of vehicle. Double click an item on the legend to view just that item distribution.
@@ -226,10 +229,14 @@ list_for_hist = ['manufacturer', 'type', 'condition']
 choice_for_hist = st.selectbox('Choose one', list_for_hist)
 
 # plot histogram where price_usd is based on the choice made in the selectbox.
-fig1 = px.histogram(data, x='price', color=choice_for_hist, title= "<b> Price by {}</b>".format(choice_for_hist))
+# the prices are binned here on the server (see charts.py) so only the bar counts are sent to the browser.
+def build_price_comparison():
+    return figures.get_or_build(
+        (fingerprint, 'price comparison', show_new_ads, choice_for_hist),
+        lambda: charts.counts_figure(*queries.histogram(by=choice_for_hist, new_only=show_new_ads), 'price', choice_for_hist, title= "<b> Price by {}</b>".format(choice_for_hist)))
 
 #add histogram visual to web app 
-st.plotly_chart(fig1)
+fig1 = page.add('price comparison', build_price_comparison, page_charts.plotly_chart)
 
 
 # %% [markdown]
@@ -246,43 +253,35 @@ fig1.show()
 # %%
 #create our section title on the user interface portion of the web app. 
 
+instrumentation.section('best value')
 st.header('Best Value')
 st.write("""
 #### Which manufacturer holds the best value? Use the drop down menus and chart below to compare prices based on vehicle manufacturer and age.
 """)
 
-# %%
-# Create age categories of vehicles with a function. 
-
-data['age'] = 2023-data['model_year']
-
-def age_category(x):
-    if x<5: return 'less than 5 years'
-    elif x>=5 and x<10: return '5-10 years'
-    elif x>= 10 and x<20: return '10-20 years'
-    else: return 'over 20 years'
-
-data['age_category']= data['age'].apply(age_category)
-
+# %% [markdown]
+# # The vehicle age and the age categories were added with the rest of the cleaning. The category bounds are in the AGE_BUCKETS table in vehicle_data.py, and the categories are kept in order from youngest to oldest.
 
 # %%
 
+# the manufacturers and vehicle ages to choose from were found with the search options above
 # Add select box for user to choose manufacturer
-vehicle_man = data['manufacturer'].unique()
 select_man = st.selectbox('Select Manufacturer', vehicle_man) 
 
 # Add select box for user to choose age of vehicle
-age_choice = data['age_category'].unique()
 select_age = st.selectbox('Select Age', age_choice)
 
-# Filter data based on user selection.
-filtered_data = data[(data['manufacturer'] == select_man) & (data['age_category'] == select_age)]
+def build_best_value():
+    # Add up the price counts of the user's manufacturer and age.
+    counts = queries.histogram(where={'manufacturer': select_man, 'age_category': select_age}, new_only=show_new_ads)
 
-# plot histogram based off user selection of manufacturer and age.
-fig2 = px.histogram(filtered_data, x='price',  title= f"Price Distribution for {select_man} Vehicles ({select_age})")
+    # plot histogram based off user selection of manufacturer and age.
+    return charts.counts_figure(*counts, 'price', title= f"Price Distribution for {select_man} Vehicles ({select_age})")
 
 #add histogram to web app using streamlit. 
-st.plotly_chart(fig2)
+fig2 = page.add(
+    'best value', lambda: figures.get_or_build((fingerprint, 'best value', show_new_ads, select_man, select_age), build_best_value),
+    page_charts.plotly_chart)
 
 # %% [markdown]
 # # Lets take a look at our histogram
@@ -291,39 +290,30 @@ st.plotly_chart(fig2)
 fig2.show()
 
 # %% [markdown]
-# ## Let's say the user wants to look at how the number of days a vehicle has been listed can affect the sales price of the vehicle. To do this we will create categories for days listed with a function called 'list_age_category'. We'll use a box plot as our visual to see how the prices compare based on the listing age. 
+# ## Let's say the user wants to look at how the number of days a vehicle has been listed can affect the sales price of the vehicle. To do this we will use the days listed categories in the 'list_age_category' column. We'll use a box plot as our visual to see how the prices compare based on the listing age. 
 
 # %% [markdown]
 # # First lets create our web app section header 
 
 # %%
+instrumentation.section('days listed')
 st.write(""" 
 ### Let's take a look at how the price can be affected by the number of days the vehicle has been listed.
 """) 
 
-# %%
-# Create days listed age group categories using a function.
-
-
-def list_age_category(x):
-    if x<7: return 'less than 7 days'
-    elif x>=7 and x<14: return '7-14 days'
-    elif x>= 14 and x<30: return '14-30 days'
-    elif x>= 30 and x<60: return '30-60 days'
-    elif x>= 60 and x<90: return '60-90 days'
-    elif x>= 90 and  x<180: return '90-180 days'
-    else: return '>180'
-
-data['list_age_category']= data['days_listed'].apply(list_age_category)
-
+# %% [markdown]
+# # The days listed categories come from the LIST_AGE_BUCKETS table in vehicle_data.py. Because they are ordered, the box plot shows them from the newest listings to the oldest.
 
 # %%
 # Create box plot using streamlit
-import altair as alt
-
-chart = alt.Chart(data).mark_boxplot(extent='min-max').encode(x='list_age_category', y='price')
 
-st.altair_chart(chart, theme="streamlit", use_container_width=True)
+# the quartiles for each listing age are computed here (see charts.py) so only those few numbers are sent to the browser.
+chart = page.add(
+    'days listed',
+    lambda: figures.get_or_build(
+        (fingerprint, 'days listed', show_new_ads),
+        lambda: charts.stats_box_chart(queries.box_stats(new_only=show_new_ads), 'list_age_category', 'price')),
+    page_charts.altair_chart)
 
 
 # %%
@@ -334,18 +324,60 @@ st.write('We can see that the longer a vehicle has been listed, the lower the pr
 
 # %%
 # Create Web app title for section. 
+instrumentation.section('mileage')
 st.write(""" 
          ### Now we will examine how mileage affects the price of a vehicle. Hover over the diagram to view price, odometer reading, and model_year of the vehicle.
          """)
-fig3 = px.scatter(data, x='price', y='odometer', hover_data = ['model_year'], title= 'Price vs. Mileage')
-st.plotly_chart(fig3)
+# with more listings than charts.SCATTER_MAX_POINTS the points are shown as a density map with a sample of them on top.
+# the points, or the density and its sample, are worked out by the queries and only drawn here
+def build_mileage():
+    aggregate = queries.scatter(MILEAGE_VIEW.where(NEW_LISTINGS) if show_new_ads else MILEAGE_VIEW, x='price', y='odometer', hover_data=['model_year'])
+    return charts.aggregate_scatter_figure(aggregate, x='price', y='odometer', hover_data=['model_year'], title='Price vs. Mileage')
+
+fig3 = page.add('mileage', lambda: figures.get_or_build((fingerprint, 'mileage', show_new_ads), build_mileage), page_charts.plotly_chart)
 
 # %%
 fig3.show()
 
+# %% [markdown]
+# ## Last, we'll let the user look up the listings most like a vehicle they have in mind, or one they are selling: the same model with the closest model year, mileage, condition and cylinders. The lookup uses the trees in comparables.py, so only the listings of that model are searched.
+
+# %%
+instrumentation.section('comparables')
+st.header('Comparable Listings')
+st.write("""
+#### Enter a vehicle to see the listings most similar to it and what they are priced at.
+""")
+
+model_col, year_col, odometer_col = st.columns(3)
+comp_model = model_col.selectbox('Model', comp_models)
+comp_year = year_col.number_input('Model year', min_value=1900, max_value=vehicle_data.CURRENT_YEAR + 1, value=vehicle_data.CURRENT_YEAR - 5, step=1)
+comp_odometer = odometer_col.number_input('Odometer', min_value=0, value=60000, step=1000)
+condition_col, cylinders_col, count_col = st.columns(3)
+comp_condition = condition_col.selectbox('Condition', comparables.CONDITIONS, index=comparables.CONDITIONS.index('good'))
+comp_cylinders = cylinders_col.number_input('Cylinders', min_value=0, max_value=16, value=6, step=1)
+comp_count = count_col.slider('Number of listings', min_value=1, max_value=50, value=comparables.NEIGHBOURS)
+
+comparable_listings = queries.comparables(
+    comp_model, comp_year, comp_odometer, comp_condition, comp_cylinders, n=comp_count,
+    columns=['price', 'model_year', 'odometer', 'condition', 'cylinders', 'type', 'days_listed'])
+instrumentation.payload('comparables', comparable_listings)
+st.dataframe(comparable_listings)
+
 # %%
 st.write("""
 #### Thank you for visiting our web app. We hope you feel more confident in your pre-owned vehicle search! 
 """)
 
+# fill in the charts still being built, from the top of the page down
+instrumentation.section('draw charts')
+page.draw()
+
+# the hits, misses and evictions of the shared figure cache so far, logged with the timings and shown in the debug panel
+instrumentation.counters('figure cache', figures.stats())
+
+rerun = instrumentation.finish()
+if 'timings' in st.experimental_get_query_params().get('debug', []):
+    instrumentation.show_panel(st.sidebar, rerun, load_recorder())
+
 
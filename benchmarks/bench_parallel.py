@@ -0,0 +1,39 @@
+"""Scaling benchmark for the parallel cleaning of parallel.py.
+
+Reads and cleans a listings CSV on one core with vehicle_data.load_vehicles
+and then with parallel.load_vehicles for every worker count, and checks that
+all of them give the same listings. Run from the repository root:
+
+    python -m benchmarks.bench_parallel                      # vehicles_us.csv, 1 to 16 workers
+    python -m benchmarks.bench_parallel big.csv 1 4 16       # chosen file and worker counts
+"""
+import sys
+import time
+
+import pandas as pd
+
+import parallel
+import vehicle_data
+
+
+WORKERS = [1, 2, 4, 8, 16]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(path, workers):
+    serial, serial_time = timed(vehicle_data.load_vehicles, path)
+    print('{:>8} {:>10} {:>9}'.format('workers', 'time (s)', 'speedup'))
+    print('{:>8} {:>10.3f} {:>9}'.format('serial', serial_time, '-'))
+    for count in workers:
+        result, result_time = timed(parallel.load_vehicles, path, count)
+        pd.testing.assert_frame_equal(serial, result, check_exact=True)
+        print('{:>8} {:>10.3f} {:>8.1f}x'.format(count, result_time, serial_time / result_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else vehicle_data.DATA_PATH, [int(arg) for arg in sys.argv[2:]] or WORKERS)
@@ -0,0 +1,204 @@
+"""Benchmark of every stage of the app on synthetic listings.
+
+For every size a CSV is generated (see synthetic.py) and then timed stage by
+stage as the app runs it:
+
+- csv_load, every step of vehicle_data.cleaning_steps (clean:*) and
+  apply_schema, and writing the snapshot
+- building the shared indexes (index:*)
+- the filters and drop down choices of the page (filter:*), with the views
+  read from the listings in memory as the app does
+- the same views read from the snapshot with pushdown (snapshot:*)
+- building every chart (figure:*) and serializing it to JSON (json:*, which
+  also records the size of the figure in bytes)
+
+Results are written as JSON, one record per size and stage. Given a baseline
+(the results of an earlier run), stages that got slower or figures that got
+bigger by more than the tolerance are listed and the exit status is 1, so a
+regression can fail a build. Run from the repository root:
+
+    python -m benchmarks.bench_pipeline                                    # 50k, 1M and 10M rows
+    python -m benchmarks.bench_pipeline 50000 --output results.json
+    python -m benchmarks.bench_pipeline 50000 --baseline benchmarks/baseline.json
+    python -m benchmarks.bench_pipeline 50000 --output benchmarks/baseline.json   # record a new baseline
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import charts
+import comparables
+import data_viewer
+import data_views
+import filter_index
+import market_cube
+import vehicle_data
+from benchmarks import synthetic
+
+
+SIZES = [50_000, 1_000_000, 10_000_000]
+
+# quick stages are run again, up to REPEAT times or for BUDGET_SECONDS in all,
+# and the quickest run is kept
+REPEAT = 20
+BUDGET_SECONDS = 1.0
+
+# a stage regresses when it takes more than 1 + TOLERANCE times its baseline,
+# and at least SLACK_SECONDS more, or its figure grows by more than TOLERANCE
+TOLERANCE = 0.25
+SLACK_SECONDS = 0.01
+
+MILEAGE_VIEW = data_views.View(['price', 'odometer', 'model_year'])
+NEW_LISTINGS = ('days_listed', '<=', market_cube.NEW_LISTING_DAYS)
+
+
+def measure(func, repeat=REPEAT):
+    """Return the result of `func()` and the seconds it took, the least of up to `repeat` runs."""
+    runs = []
+    while len(runs) < repeat and sum(runs) < BUDGET_SECONDS:
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return result, min(runs)
+
+
+def run_pipeline(path, snapshot_path):
+    """Time every stage on the listings in the CSV at `path`, returning (stage, seconds, bytes) tuples."""
+    timings = []
+
+    def stage(name, func, repeat=REPEAT):
+        result, seconds = measure(func, repeat)
+        timings.append((name, seconds, None))
+        return result
+
+    data = stage('csv_load', lambda: pd.read_csv(path, dtype=vehicle_data.CSV_DTYPES), repeat=1)
+    for name, function, _, _ in vehicle_data.cleaning_steps():
+        columns = stage('clean:' + name, lambda: function(data))
+        for column, values in columns.items():
+            data[column] = values
+    stage('clean:apply_schema', lambda: vehicle_data.apply_schema(data), repeat=1)
+    stage('snapshot_write', lambda: vehicle_data.write_snapshot(data, 'benchmark', snapshot_path), repeat=1)
+
+    index = stage('index:filter', lambda: filter_index.FilterIndex(data))
+    sort_index = stage('index:sort', lambda: data_viewer.SortIndex(data))
+    cube = stage('index:market_cube', lambda: market_cube.MarketCube(data))
+    comparable_index = stage('index:comparables', lambda: comparables.ComparablesIndex(data))
+    source = data_views.FrameSource(data)
+    snapshot = data_views.SnapshotSource(snapshot_path, 'benchmark')
+
+    # the most common choices, as a user would first see them
+    vehicle_type = data['type'].value_counts().index[0]
+    manufacturer = data['manufacturer'].value_counts().index[0]
+    age = data['age_category'].value_counts().index[0]
+    model = data['model'].value_counts().index[0]
+    low, high = data['price'].quantile([0.25, 0.75]).astype(int)
+
+    rows = stage('filter:new_listings', lambda: index.query(ranges={'days_listed': (None, market_cube.NEW_LISTING_DAYS)}))
+    stage('filter:search_options', lambda: (cube.domain('type'), cube.value_range()))
+    table_rows = stage('filter:type_price', lambda: index.query(equals={'type': vehicle_type}, ranges={'price': (low, high)}))
+    stage('filter:type_price_new', lambda: index.query(equals={'type': vehicle_type}, ranges={'price': (low, high)}, rows=rows))
+    stage('filter:table_page', lambda: sort_index.page(table_rows, by='price'))
+    stage('filter:best_value_options', lambda: (cube.domain('manufacturer'), cube.domain('age_category')))
+    stage('filter:mileage_view', lambda: source.read(MILEAGE_VIEW))
+    stage('filter:mileage_view_new', lambda: source.read(MILEAGE_VIEW.where(NEW_LISTINGS)))
+    stage('snapshot:mileage_view', lambda: snapshot.read(MILEAGE_VIEW))
+    stage('snapshot:mileage_view_new', lambda: snapshot.read(MILEAGE_VIEW.where(NEW_LISTINGS)))
+    stage('filter:comparables', lambda: comparable_index.nearest(model, vehicle_data.CURRENT_YEAR - 5, 60_000, 'good', 6))
+
+    figures = {
+        'price_by_' + by: (lambda by=by: charts.counts_figure(*cube.histogram(by=by), 'price', by, title='<b> Price by {}</b>'.format(by)))
+        for by in ['manufacturer', 'type', 'condition']
+    }
+    figures['best_value'] = lambda: charts.counts_figure(*cube.histogram(where={'manufacturer': manufacturer, 'age_category': age}), 'price')
+    figures['days_listed_box'] = lambda: charts.stats_box_chart(cube.box_stats(), 'list_age_category', 'price')
+    figures['mileage_scatter'] = lambda: charts.scatter_figure(source.read(MILEAGE_VIEW), x='price', y='odometer', hover_data=['model_year'])
+    for name, build in figures.items():
+        # the first chart of a process also pays for loading plotly or altair
+        build()
+        figure = stage('figure:' + name, build)
+        payload, seconds = measure(figure.to_json)
+        timings.append(('json:' + name, seconds, len(payload.encode())))
+    return timings
+
+
+def benchmark(sizes, seed=0, data_dir=None):
+    """Return the result records of every stage for listings of every size in `sizes`.
+
+    The CSV files are generated in `data_dir`, and reused from there when
+    they already exist, or in a temporary directory.
+    """
+    records = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for n in sizes:
+            path = os.path.join(data_dir or scratch, 'vehicles_{}_{}.csv'.format(n, seed))
+            if not os.path.exists(path):
+                synthetic.write_vehicles(path, n, seed)
+            for stage, seconds, size in run_pipeline(path, os.path.join(scratch, 'vehicles.parquet')):
+                records.append({'rows': n, 'stage': stage, 'seconds': seconds, 'bytes': size})
+    return records
+
+
+def regressions(records, baseline, tolerance=TOLERANCE):
+    """Return a line for every record of `records` that is worse than the same record in `baseline`."""
+    before = {(record['rows'], record['stage']): record for record in baseline}
+    found = []
+    for record in records:
+        old = before.get((record['rows'], record['stage']))
+        if old is None:
+            continue
+        if record['seconds'] > old['seconds'] * (1 + tolerance) and record['seconds'] - old['seconds'] > SLACK_SECONDS:
+            found.append('{:>12,} {:<28} {:.4f}s -> {:.4f}s'.format(record['rows'], record['stage'], old['seconds'], record['seconds']))
+        if old['bytes'] and record['bytes'] > old['bytes'] * (1 + tolerance):
+            found.append('{:>12,} {:<28} {:,} -> {:,} bytes'.format(record['rows'], record['stage'], old['bytes'], record['bytes']))
+    return found
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time every stage of the app on synthetic listings.')
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES, help='numbers of rows to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='directory to keep the generated CSV files in')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    records = benchmark(args.sizes, args.seed, args.data_dir)
+    print('{:>12} {:<28} {:>10} {:>12}'.format('rows', 'stage', 'seconds', 'bytes'))
+    for record in records:
+        print('{:>12,} {:<28} {:>10.4f} {:>12}'.format(
+            record['rows'], record['stage'], record['seconds'], '' if record['bytes'] is None else '{:,}'.format(record['bytes'])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'seed': args.seed, 'results': records}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != environment():
+            print('\nthe baseline was recorded on {}, timings may not compare'.format(baseline['environment']))
+        found = regressions(records, baseline['results'], args.tolerance)
+        print('\n{} regression(s) against {}'.format(len(found), args.baseline))
+        for line in found:
+            print(line)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
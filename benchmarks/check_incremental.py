@@ -0,0 +1,105 @@
+"""Check that refreshing the listings as the CSV grows gives what a full rebuild gives.
+
+incremental.ListingFeed only cleans the listings appended to the CSV and
+updates the indexes and the market cube instead of building them again. This
+writes synthetic listings (see synthetic.py) to a CSV slice by slice and,
+after every slice, compares the refreshed listings with incremental.Listings
+built from scratch from the CSV cleaned by vehicle_data.load_vehicles: the
+cleaned frame, FilterIndex, SortIndex, MarketCube and ComparablesIndex,
+every array of them. The first slice leaves out a vehicle type and a few
+models, so later slices also add categories and imputation groups. Run from
+the repository root:
+
+    python -m benchmarks.check_incremental                  # 50k listings in 5 slices
+    python -m benchmarks.check_incremental 200000 10
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import incremental
+import vehicle_data
+from benchmarks import synthetic
+
+
+ROWS = 50_000
+SLICES = 5
+
+# held back from the first slice
+HELD_TYPES = 1
+HELD_MODELS = 5
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def assert_same(name, left, right):
+    """Raise AssertionError naming the first part of `left` that is not exactly `right`.
+
+    Frames, arrays, dicts, lists and the attributes of objects are compared
+    all the way down.
+    """
+    if isinstance(left, pd.DataFrame):
+        pd.testing.assert_frame_equal(left, right, check_exact=True, obj=name)
+    elif isinstance(left, pd.Series):
+        pd.testing.assert_series_equal(left, right, check_exact=True, obj=name)
+    elif isinstance(left, pd.Index):
+        pd.testing.assert_index_equal(left, right, exact=True, obj=name)
+    elif isinstance(left, np.ndarray):
+        assert isinstance(right, np.ndarray) and left.dtype == right.dtype, name
+        assert np.array_equal(left, right, equal_nan=left.dtype.kind == 'f'), name
+    elif isinstance(left, dict):
+        assert list(left) == list(right), name
+        for key in left:
+            assert_same('{}[{!r}]'.format(name, key), left[key], right[key])
+    elif isinstance(left, (list, tuple)):
+        assert len(left) == len(right), name
+        for i, (left_item, right_item) in enumerate(zip(left, right)):
+            assert_same('{}[{}]'.format(name, i), left_item, right_item)
+    elif hasattr(left, '__dict__'):
+        assert type(left) is type(right), name
+        assert_same(name, vars(left), vars(right))
+    else:
+        assert left == right or (left != left and right != right), name
+
+
+def slices(data, count, seed=0):
+    """Return `data` in `count` slices, the first one without a vehicle type and a few models."""
+    held = data['type'].isin(data['type'].value_counts().index[-HELD_TYPES:])
+    held |= data['model'].isin(data['model'].value_counts().index[-HELD_MODELS:])
+    first = data[~held].iloc[:len(data) // count]
+    rest = data.drop(first.index)
+    rest = rest.iloc[np.random.default_rng(seed).permutation(len(rest))]
+    return [first] + [rest.iloc[positions] for positions in np.array_split(np.arange(len(rest)), count - 1)]
+
+
+def rebuild(path):
+    """Return the listings of the CSV at `path` built from scratch."""
+    return incremental.Listings(None, None, vehicle_data.load_vehicles(path))
+
+
+def main(rows, count):
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'vehicles.csv')
+        feed = incremental.ListingFeed(path, os.path.join(scratch, 'vehicles.parquet'))
+        print('{:>10} {:>12} {:>12}'.format('rows', 'refresh (s)', 'rebuild (s)'))
+        for number, part in enumerate(slices(synthetic.make_vehicles(rows), count)):
+            part.to_csv(path, mode='w' if number == 0 else 'a', header=number == 0, index=False)
+            listings, refresh_time = timed(feed.current)
+            rebuilt, rebuild_time = timed(rebuild, path)
+            assert listings.source_hash == vehicle_data.file_hash(path)
+            for name in vars(rebuilt):
+                if name not in ('fingerprint', 'source_hash'):
+                    assert_same(name, getattr(listings, name), getattr(rebuilt, name))
+            print('{:>10,} {:>12.3f} {:>12.3f}'.format(len(listings.data), refresh_time, rebuild_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else ROWS, int(sys.argv[2]) if len(sys.argv) > 2 else SLICES)
@@ -0,0 +1,381 @@
+"""Load test of the app with many concurrent sessions, all on this machine.
+
+Starts one or more `streamlit run app.py` processes and connects headless
+sessions to them over the same websocket the browser uses. Every session
+loads the page and then plays INTERACTIONS, a visitor comparing prices:
+switching the histogram, picking a manufacturer and an age, dragging the
+price slider and toggling the 30 day checkbox. A session sends the widget
+values of an interaction, waits until the rerun it caused has finished, and
+pauses for a random think time before the next one.
+
+The report has the latency of every kind of rerun (p50/p95/p99), the number
+of reruns per second, the bytes the app sent per rerun and, for every server
+process, its memory before, during and after the test. The servers log their
+own section timings (see instrumentation.py), which are summarized as well.
+With --query-service the servers share one query service (see
+query_service.py), whose memory is reported with theirs, and with --warm-up
+they are started by warmup.py, so they only answer once their caches are
+warm. Run from the repository root:
+
+    python -m benchmarks.load_test --sessions 20 --rows 1000000
+    python -m benchmarks.load_test --sessions 50 --servers 4 --data-dir /srv/vehicles --output load.json
+    python -m benchmarks.load_test --sessions 50 --servers 4 --query-service --rows 1000000
+    python -m benchmarks.load_test --sessions 20 --warm-up --rows 1000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from tornado.websocket import websocket_connect
+
+import query_service
+import vehicle_data
+from benchmarks import synthetic
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, 'app.py')
+QUERY_SERVICE_PATH = os.path.join(ROOT, 'query_service.py')
+WARMUP_PATH = os.path.join(ROOT, 'warmup.py')
+QUERY_SERVICE = 'query service'
+FIRST_PORT = 8601
+STARTUP_SECONDS = 300
+SAMPLE_SECONDS = 0.5
+PERCENTILES = [50, 95, 99]
+
+NEW_ADS = 'Show vehicles listed in last 30 days'
+PRICE_RANGE = 'Choose price range'
+HISTOGRAM = 'Choose one'
+MANUFACTURER = 'Select Manufacturer'
+AGE = 'Select Age'
+
+# one visit: the interactions, in order, of a visitor comparing prices
+INTERACTIONS = ['histogram', 'manufacturer', 'age', 'price_range', 'new_ads',
+                'price_range', 'histogram', 'manufacturer', 'age', 'new_ads']
+
+
+def toggle(widget, rng):
+    return 'bool_value', not widget['value']
+
+
+def pick(widget, rng):
+    others = [i for i in range(len(widget['options'])) if i != widget['value']] or [widget['value']]
+    return 'int_value', int(rng.choice(others))
+
+
+def drag(widget, rng):
+    low, high = sorted(rng.uniform(widget['min'], widget['max'], 2).round())
+    return 'double_array_value', [low, high]
+
+
+ACTIONS = {
+    'new_ads': (NEW_ADS, toggle),
+    'price_range': (PRICE_RANGE, drag),
+    'histogram': (HISTOGRAM, pick),
+    'manufacturer': (MANUFACTURER, pick),
+    'age': (AGE, pick),
+}
+
+
+def widget_of(element):
+    """Return the id, label, kind and value of the widget `element` shows, or None."""
+    kind = element.WhichOneof('type')
+    proto = getattr(element, kind)
+    if not getattr(proto, 'id', ''):
+        return None
+    widget = {'id': proto.id, 'label': proto.label, 'kind': kind, 'options': list(getattr(proto, 'options', []))}
+    if kind == 'slider':
+        widget.update(value=list(proto.default), min=proto.min, max=proto.max)
+    elif kind in ('checkbox', 'selectbox'):
+        widget['value'] = proto.default
+    return widget
+
+
+class Session:
+    """A headless browser tab connected to the server on `port`."""
+
+    def __init__(self, port, seed):
+        self.port = port
+        self.rng = np.random.default_rng(seed)
+        self.connection = None
+        self.widgets = {}
+        self.states = {}
+
+    async def connect(self):
+        self.connection = await websocket_connect('ws://127.0.0.1:{}/_stcore/stream'.format(self.port))
+
+    async def rerun(self):
+        """Send the widget values, wait for the rerun and return its seconds, bytes and whether it failed."""
+        message = BackMsg()
+        message.rerun_script.query_string = ''
+        for widget_id, (field, value) in self.states.items():
+            state = message.rerun_script.widget_states.widgets.add()
+            state.id = widget_id
+            if field == 'double_array_value':
+                state.double_array_value.data.extend(value)
+            else:
+                setattr(state, field, value)
+
+        start = time.perf_counter()
+        await self.connection.write_message(message.SerializeToString(), binary=True)
+        received = 0
+        failed = False
+        widgets = {}
+        while True:
+            raw = await self.connection.read_message()
+            if raw is None:
+                raise ConnectionError('the server closed the session')
+            received += len(raw)
+            reply = ForwardMsg()
+            reply.ParseFromString(raw)
+            kind = reply.WhichOneof('type')
+            if kind == 'delta' and reply.delta.WhichOneof('type') == 'new_element':
+                element = reply.delta.new_element
+                failed |= element.WhichOneof('type') == 'exception'
+                widget = widget_of(element)
+                if widget is not None:
+                    widgets.setdefault(widget['label'], widget)
+            elif kind == 'script_finished':
+                failed |= reply.script_finished != ForwardMsg.FINISHED_SUCCESSFULLY
+                break
+        seconds = time.perf_counter() - start
+
+        # widgets whose parameters changed are new widgets, back at their default
+        ids = {widget['id'] for widget in widgets.values()}
+        self.states = {widget_id: state for widget_id, state in self.states.items() if widget_id in ids}
+        for widget in widgets.values():
+            if widget['id'] in self.states and 'value' in widget:
+                value = self.states[widget['id']][1]
+                widget['value'] = value
+        self.widgets = widgets
+        return seconds, received, failed
+
+    async def interact(self, action):
+        """Change the widget of `action` as a visitor would and rerun."""
+        label, change = ACTIONS[action]
+        widget = self.widgets[label]
+        self.states[widget['id']] = change(widget, self.rng)
+        return await self.rerun()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+async def visit(number, port, visits, think, ramp, results):
+    """Run a session that loads the page and plays INTERACTIONS `visits` times."""
+    rng = random.Random(number)
+    await asyncio.sleep(ramp * rng.random())
+    session = Session(port, number)
+    try:
+        await session.connect()
+        results.append(('load', port) + await session.rerun())
+        for _ in range(visits):
+            for action in INTERACTIONS:
+                await asyncio.sleep(rng.expovariate(1 / think) if think else 0)
+                results.append((action, port) + await session.interact(action))
+    except Exception as error:
+        results.append(('error', port, 0.0, 0, True))
+        print('session {}: {!r}'.format(number, error), file=sys.stderr)
+    finally:
+        session.close()
+
+
+def rss_bytes(pid):
+    """Return the resident memory of process `pid` and its children, from /proc."""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open('/proc/{}/status'.format(current)) as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+            with open('/proc/{0}/task/{0}/children'.format(current)) as f:
+                pids += [int(child) for child in f.read().split()]
+        except (OSError, StopIteration):
+            pass
+    return total
+
+
+async def sample_memory(servers, peaks, stop):
+    while not stop.is_set():
+        for port, process in servers.items():
+            peaks[port] = max(peaks.get(port, 0), rss_bytes(process.pid))
+        try:
+            await asyncio.wait_for(stop.wait(), SAMPLE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_query_service(data_dir, address):
+    """Start a query service on the listings in `data_dir` and wait until it listens on `address`."""
+    process = subprocess.Popen(
+        [sys.executable, QUERY_SERVICE_PATH, vehicle_data.DATA_PATH, address],
+        cwd=data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_SECONDS
+    while not os.path.exists(address):
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError('the query service did not start')
+        time.sleep(0.2)
+    return process
+
+
+def start_servers(count, data_dir, log_dir, query_address=None, warm_up=False):
+    """Start `count` app servers in `data_dir` and wait until they answer.
+
+    With `query_address` they send their queries to the service listening
+    there, and with `warm_up` they warm their caches before answering.
+    """
+    servers = {}
+    for port in range(FIRST_PORT, FIRST_PORT + count):
+        env = dict(os.environ, TIMINGS_LOG=os.path.join(log_dir, 'timings-{}.log'.format(port)))
+        if query_address:
+            env[query_service.ADDRESS_VARIABLE] = query_address
+        command = [WARMUP_PATH] if warm_up else ['-m', 'streamlit', 'run', APP_PATH]
+        servers[port] = subprocess.Popen(
+            [sys.executable] + command + ['--server.port', str(port),
+                                          '--server.headless', 'true', '--browser.gatherUsageStats', 'false'],
+            cwd=data_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_SECONDS
+    for port in servers:
+        while True:
+            try:
+                urllib.request.urlopen('http://127.0.0.1:{}/_stcore/health'.format(port), timeout=1).read()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError('the server on port {} did not start'.format(port))
+                time.sleep(0.2)
+    return servers
+
+
+async def run(sessions, servers, visits, think, ramp, processes=None):
+    """Run the sessions, spread over the `servers`, and return their results and the memory peaks.
+
+    The memory of `processes` (by default the servers) is sampled.
+    """
+    results = []
+    peaks = {}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_memory(processes or servers, peaks, stop))
+    ports = list(servers)
+    start = time.perf_counter()
+    await asyncio.gather(*[visit(number, ports[number % len(ports)], visits, think, ramp, results) for number in range(sessions)])
+    seconds = time.perf_counter() - start
+    stop.set()
+    await sampler
+    return results, seconds, peaks
+
+
+def latency_table(results):
+    """Return the count, percentiles in milliseconds and bytes of every kind of rerun."""
+    frame = pd.DataFrame(results, columns=['action', 'port', 'seconds', 'bytes', 'failed'])
+    frame = frame[frame['action'] != 'error']
+    groups = list(frame.groupby('action', sort=False)) + [('all', frame)]
+    return pd.DataFrame(
+        [[len(group), int(group['failed'].sum())] + list(np.percentile(group['seconds'], PERCENTILES) * 1000) + [group['bytes'].median()]
+         for _, group in groups],
+        index=pd.Index([name for name, _ in groups], name='rerun'),
+        columns=['count', 'failed'] + ['p{}_ms'.format(p) for p in PERCENTILES] + ['median_bytes'],
+    )
+
+
+def section_table(log_dir):
+    """Return the percentiles in milliseconds of every section the servers logged."""
+    seconds = {}
+    for name in os.listdir(log_dir):
+        with open(os.path.join(log_dir, name)) as f:
+            for line in f:
+                record = json.loads(line)
+                for section, value in list(record['sections'].items()) + [('total', record['seconds'])]:
+                    seconds.setdefault(section, []).append(value)
+    return pd.DataFrame(
+        [[len(values)] + list(np.percentile(values, PERCENTILES) * 1000) for values in seconds.values()],
+        index=pd.Index(list(seconds), name='section'),
+        columns=['count'] + ['p{}_ms'.format(p) for p in PERCENTILES],
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the app with concurrent headless sessions.')
+    parser.add_argument('--sessions', type=int, default=10, help='concurrent sessions')
+    parser.add_argument('--servers', type=int, default=1, help='app processes to spread the sessions over')
+    parser.add_argument('--visits', type=int, default=3, help='times every session plays the interactions')
+    parser.add_argument('--think', type=float, default=0.5, help='mean seconds between interactions')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds over which the sessions connect')
+    parser.add_argument('--data-dir', help='directory holding vehicles_us.csv (default: the current one)')
+    parser.add_argument('--rows', type=int, help='generate a synthetic vehicles_us.csv with this many rows instead')
+    parser.add_argument('--query-service', action='store_true', help='have the servers share one query service')
+    parser.add_argument('--warm-up', action='store_true', help='warm the caches of the servers before they answer')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        data_dir = os.path.abspath(args.data_dir or os.getcwd())
+        if args.rows:
+            data_dir = scratch
+            synthetic.write_vehicles(os.path.join(data_dir, vehicle_data.DATA_PATH), args.rows)
+        log_dir = os.path.join(scratch, 'logs')
+        os.mkdir(log_dir)
+
+        processes = {}
+        query_address = None
+        try:
+            if args.query_service:
+                query_address = os.path.join(scratch, query_service.SOCKET_PATH)
+                processes[QUERY_SERVICE] = start_query_service(data_dir, query_address)
+            servers = start_servers(args.servers, data_dir, log_dir, query_address, args.warm_up)
+            processes.update(servers)
+            idle = {port: rss_bytes(process.pid) for port, process in processes.items()}
+            results, seconds, peaks = asyncio.run(run(args.sessions, servers, args.visits, args.think, args.ramp, processes))
+            after = {port: rss_bytes(process.pid) for port, process in processes.items()}
+        finally:
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                process.wait()
+        sections = section_table(log_dir)
+
+    latency = latency_table(results)
+    memory = pd.DataFrame({'idle_mb': idle, 'peak_mb': peaks, 'after_mb': after}).rename_axis('port') / 2 ** 20
+    memory['growth_mb'] = memory['after_mb'] - memory['idle_mb']
+    reruns = int(latency.loc['all', 'count']) if 'all' in latency.index else 0
+    errors = sum(1 for result in results if result[0] == 'error')
+
+    pd.set_option('display.width', 120)
+    print('{} sessions on {} server(s){}: {:,} reruns in {:.1f} s, {:.1f} reruns/s, {} failed sessions\n'.format(
+        args.sessions, args.servers, ' sharing a query service' if args.query_service else '', reruns, seconds, reruns / seconds, errors))
+    print(latency.round(1), end='\n\n')
+    print(memory.round(1), end='\n\n')
+    print(sections.round(1))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'sessions': args.sessions,
+                'servers': args.servers,
+                'query_service': args.query_service,
+                'warm_up': args.warm_up,
+                'seconds': seconds,
+                'reruns_per_second': reruns / seconds,
+                'failed_sessions': errors,
+                'latency': latency.reset_index().to_dict('records'),
+                'memory': memory.reset_index().to_dict('records'),
+                'sections': sections.reset_index().to_dict('records'),
+            }, f, indent=1)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
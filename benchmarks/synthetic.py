@@ -0,0 +1,119 @@
+"""Synthetic listings shaped like vehicles_us.csv, at any size.
+
+The columns, the number of distinct values of every text column, how often
+each value occurs and the share of missing values follow the real
+vehicles_us.csv (about 51k listings of 100 models). Ages, mileages and prices
+are drawn so that older vehicles have more miles and lower prices. The same
+size and seed always give the same file. Run from the repository root:
+
+    python -m benchmarks.synthetic 1000000 vehicles_1m.csv       # 1M rows, seed 0
+    python -m benchmarks.synthetic 1000000 vehicles_1m.csv 7     # another seed
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ['price', 'model_year', 'model', 'condition', 'cylinders', 'fuel', 'odometer',
+           'transmission', 'type', 'paint_color', 'is_4wd', 'date_posted', 'days_listed']
+
+MODELS = {
+    'chevrolet': ['silverado 1500', 'silverado', 'silverado 2500hd', 'silverado 1500 crew', 'silverado 3500hd',
+                  'malibu', 'impala', 'equinox', 'tahoe', 'traverse', 'cruze', 'suburban', 'colorado',
+                  'corvette', 'camaro', 'camaro lt coupe 2d', 'trailblazer'],
+    'ford': ['f-150', 'f150', 'f-250', 'f-250 sd', 'f-250 super duty', 'f-350 sd', 'f150 supercrew cab xlt',
+             'fusion', 'fusion se', 'focus', 'focus se', 'escape', 'explorer', 'edge', 'expedition',
+             'mustang', 'mustang gt coupe 2d', 'ranger', 'taurus', 'econoline'],
+    'toyota': ['camry', 'camry le', 'corolla', 'rav4', 'tacoma', 'tundra', 'highlander', '4runner', 'prius', 'sienna'],
+    'honda': ['accord', 'civic', 'civic lx', 'cr-v', 'pilot', 'odyssey'],
+    'ram': ['1500', '2500', '3500'],
+    'jeep': ['wrangler', 'wrangler unlimited', 'grand cherokee', 'grand cherokee laredo', 'cherokee', 'liberty', 'compass'],
+    'nissan': ['altima', 'rogue', 'sentra', 'maxima', 'murano', 'versa', 'frontier', 'frontier crew cab sv'],
+    'gmc': ['sierra', 'sierra 1500', 'sierra 2500hd', 'yukon', 'acadia'],
+    'subaru': ['outback', 'forester', 'impreza'],
+    'dodge': ['charger', 'grand caravan', 'dakota'],
+    'kia': ['soul', 'sorento', 'optima', 'forte'],
+    'hyundai': ['elantra', 'sonata', 'santa fe'],
+    'volkswagen': ['jetta', 'passat'],
+    'chrysler': ['200', '300', 'town & country', 'pacifica'],
+    'buick': ['enclave'],
+    'cadillac': ['escalade'],
+    'bmw': ['x5'],
+    'acura': ['tl'],
+    'mercedes-benz': ['benze sprinter 2500'],
+}
+
+# share of the listings with every value, among those that have one
+TYPES = {'SUV': 0.241, 'truck': 0.240, 'sedan': 0.239, 'pickup': 0.135, 'coupe': 0.045, 'wagon': 0.030,
+         'mini-van': 0.022, 'hatchback': 0.020, 'van': 0.012, 'convertible': 0.0087, 'other': 0.0050,
+         'offroad': 0.0041, 'bus': 0.0005}
+CONDITIONS = {'excellent': 0.480, 'good': 0.391, 'like new': 0.092, 'fair': 0.031, 'new': 0.0027, 'salvage': 0.0022}
+FUELS = {'gas': 0.917, 'diesel': 0.072, 'hybrid': 0.0079, 'other': 0.0021, 'electric': 0.0013}
+TRANSMISSIONS = {'automatic': 0.910, 'manual': 0.055, 'other': 0.035}
+PAINT_COLORS = {'white': 0.237, 'black': 0.182, 'silver': 0.147, 'grey': 0.122, 'blue': 0.106, 'red': 0.104,
+                'green': 0.033, 'brown': 0.029, 'custom': 0.027, 'yellow': 0.0061, 'orange': 0.0055, 'purple': 0.0024}
+CYLINDERS = {8: 0.342, 6: 0.340, 4: 0.306, 10: 0.0062, 5: 0.0052, 3: 0.0004, 12: 0.0001}
+
+# share of the listings missing every column
+MISSING = {'model_year': 0.070, 'cylinders': 0.102, 'odometer': 0.153, 'paint_color': 0.180, 'is_4wd': 0.504}
+
+FIRST_POSTED = '2018-05-01'
+POSTED_DAYS = 354
+LAST_MODEL_YEAR = 2019
+CHUNK_ROWS = 1_000_000
+
+
+def model_names():
+    return ['{} {}'.format(manufacturer, model) for manufacturer, models in MODELS.items() for model in models]
+
+
+def choose(rng, shares, n):
+    """Return `n` random keys of `shares`, each drawn with its share."""
+    keys = list(shares)
+    weights = np.array([shares[key] for key in keys])
+    return np.asarray(keys, dtype=object)[rng.choice(len(keys), n, p=weights / weights.sum())]
+
+
+def make_vehicles(n, seed=0):
+    """Return `n` synthetic listings with the columns of vehicles_us.csv, as read by pd.read_csv."""
+    rng = np.random.default_rng(seed)
+
+    # a few models make up most of the listings, as in the real file
+    models = model_names()
+    popularity = 1 / np.arange(1, len(models) + 1) ** 0.6
+    age = np.minimum(np.round(rng.gamma(2.2, 3.8, n)), LAST_MODEL_YEAR - 1908)
+    data = pd.DataFrame({
+        'price': np.clip(np.round(rng.lognormal(np.log(25_000), 0.5, n) * 0.88 ** age), 1, 375_000).astype(np.int64),
+        'model_year': LAST_MODEL_YEAR - age,
+        'model': choose(rng, dict(zip(models, popularity)), n),
+        'condition': choose(rng, CONDITIONS, n),
+        'cylinders': choose(rng, CYLINDERS, n).astype('float64'),
+        'fuel': choose(rng, FUELS, n),
+        'odometer': np.minimum(np.round(np.maximum(age, 0.5) * 12_000 * rng.lognormal(0, 0.45, n)), 990_000),
+        'transmission': choose(rng, TRANSMISSIONS, n),
+        'type': choose(rng, TYPES, n),
+        'paint_color': choose(rng, PAINT_COLORS, n),
+        'is_4wd': np.ones(n),
+        'date_posted': (pd.Timestamp(FIRST_POSTED) + pd.to_timedelta(rng.integers(0, POSTED_DAYS + 1, n), unit='D')).strftime('%Y-%m-%d'),
+        'days_listed': np.minimum(np.round(rng.gamma(2.0, 20.0, n)), 271).astype(np.int64),
+    }, columns=COLUMNS)
+    for column, share in MISSING.items():
+        data.loc[rng.random(n) < share, column] = np.nan
+    return data
+
+
+def write_vehicles(path, n, seed=0, chunk_rows=CHUNK_ROWS):
+    """Write `n` synthetic listings to the CSV at `path`, `chunk_rows` at a time.
+
+    Every chunk has its own seed derived from `seed`, so large files are
+    written without holding them in memory.
+    """
+    for number, start in enumerate(range(0, max(n, 1), chunk_rows)):
+        chunk = make_vehicles(min(chunk_rows, n - start), seed=[seed, number])
+        chunk.to_csv(path, mode='w' if number == 0 else 'a', header=number == 0, index=False)
+    return path
+
+
+if __name__ == '__main__':
+    write_vehicles(sys.argv[2], int(sys.argv[1]), int(sys.argv[3]) if len(sys.argv) > 3 else 0)
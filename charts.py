@@ -0,0 +1,197 @@
+"""Chart builders that aggregate the listings before they are sent to the browser.
+
+Plotly Express charts embed every row of their data in the figure, and the
+browser does the binning. The builders here do the aggregation on the server,
+so the size of a figure depends on the number of bins and groups rather than
+the number of listings.
+"""
+import altair as alt
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+
+NBINS = 100
+
+# Scatter plots with more points than this are drawn as a density raster with
+# a sample of the points on top, instead of one SVG marker per listing.
+SCATTER_MAX_POINTS = 5000
+SCATTER_SAMPLE_PER_CELL = 1
+
+
+def nice_bin_size(low, high, nbins=NBINS):
+    """Return a round bin size (1, 2 or 5 times a power of ten) giving about `nbins` bins."""
+    span = max(high - low, 1)
+    magnitude = 10 ** np.floor(np.log10(span / nbins))
+    for step in (1, 2, 5, 10):
+        if span / (step * magnitude) <= nbins:
+            return step * magnitude
+    return 10 * magnitude
+
+
+def bin_positions(values, nbins=NBINS):
+    """Place `values` (with no missing entries) in round sized bins.
+
+    Returns the bin edges and the bin number of every value.
+    """
+    size = nice_bin_size(values.min(), values.max(), nbins)
+    start = np.floor(values.min() / size) * size
+    count = int((values.max() - start) // size) + 1
+    bins = ((values - start) // size).astype(np.intp)
+    return start + size * np.arange(count + 1), bins
+
+
+def counts_figure(edges, labels, counts, x, color=None, title=None):
+    """Return a stacked histogram of counts in round sized bins.
+
+    `edges` are the bin edges, `labels` the group labels and `counts` a
+    (groups, bins) array of counts, as MarketCube.histogram returns them.
+    `x` and `color` are the names shown for the binned values and the groups.
+    """
+    centers = (edges[:-1] + edges[1:]) / 2
+    bars = pd.DataFrame({
+        x: np.tile(centers, len(labels)),
+        'count': counts.ravel(),
+        'bin': ['{:,.0f} - {:,.0f}'.format(low, high) for low, high in zip(edges[:-1], edges[1:])] * len(labels),
+    })
+    options = {'hover_data': {x: False, 'bin': True}}
+    if color is not None:
+        bars[color] = np.repeat(np.asarray(labels, dtype=object), len(centers))
+        options.update(color=color, category_orders={color: list(labels)})
+    bars = bars[bars['count'] > 0]
+
+    fig = px.bar(bars, x=x, y='count', title=title, **options)
+    fig.update_traces(width=edges[1] - edges[0])
+    fig.update_layout(bargap=0, barmode='relative')
+    return fig
+
+
+def stratified_sample(cells, per_cell, seed=0):
+    """Return the positions of at most `per_cell` random entries from every cell.
+
+    `cells` holds the cell number of every entry. The same input always gives
+    the same sample.
+    """
+    shuffled = np.random.default_rng(seed).permutation(len(cells))
+    order = shuffled[np.argsort(cells[shuffled], kind='stable')]
+    sorted_cells = cells[order]
+    first = np.searchsorted(sorted_cells, sorted_cells, side='left')
+    rank = np.arange(len(order)) - first
+    return np.sort(order[rank < per_cell])
+
+
+def scatter_figure(data, x, y, hover_data=(), title=None, max_points=SCATTER_MAX_POINTS,
+                   nbins=NBINS, sample_per_cell=SCATTER_SAMPLE_PER_CELL):
+    """Return a scatter plot of columns `x` and `y` of `data`.
+
+    Up to `max_points` rows this is the same as px.scatter. Above it, the
+    points are counted on a grid on the server and drawn as a heatmap, with a
+    WebGL layer of at most `sample_per_cell` points per grid cell for hovering
+    (none when `sample_per_cell` is 0).
+    """
+    return aggregate_scatter_figure(scatter_aggregate(data, x, y, hover_data, max_points, nbins, sample_per_cell), x, y, hover_data, title)
+
+
+def scatter_aggregate(data, x, y, hover_data=(), max_points=SCATTER_MAX_POINTS,
+                      nbins=NBINS, sample_per_cell=SCATTER_SAMPLE_PER_CELL):
+    """Return what scatter_figure draws for `data`, which is small whatever the size of `data`.
+
+    That is the columns of at most `max_points` rows to draw as they are, or
+    the grid edges, the count in every cell and the sampled rows.
+    """
+    columns = list(dict.fromkeys([x, y] + list(hover_data)))
+    if len(data) <= max_points:
+        return {'points': data[columns]}
+
+    data = data.dropna(subset=[x, y])
+    x_edges, x_bins = bin_positions(data[x].to_numpy(dtype='float64'), nbins)
+    y_edges, y_bins = bin_positions(data[y].to_numpy(dtype='float64'), nbins)
+    cells = y_bins * (len(x_edges) - 1) + x_bins
+    counts = np.bincount(cells, minlength=(len(x_edges) - 1) * (len(y_edges) - 1))
+    counts = counts.reshape(len(y_edges) - 1, len(x_edges) - 1).astype('float64')
+    counts[counts == 0] = np.nan
+    sample = data.iloc[stratified_sample(cells, sample_per_cell)][columns] if sample_per_cell else None
+    return {'x_edges': x_edges, 'y_edges': y_edges, 'counts': counts, 'sample': sample}
+
+
+def aggregate_scatter_figure(aggregate, x, y, hover_data=(), title=None):
+    """Return the scatter plot of the output of scatter_aggregate."""
+    hover_data = list(hover_data)
+    if 'points' in aggregate:
+        return px.scatter(aggregate['points'], x=x, y=y, hover_data=hover_data, title=title)
+
+    x_edges, y_edges = aggregate['x_edges'], aggregate['y_edges']
+    fig = go.Figure(go.Heatmap(
+        x=(x_edges[:-1] + x_edges[1:]) / 2,
+        y=(y_edges[:-1] + y_edges[1:]) / 2,
+        z=aggregate['counts'],
+        colorscale='Blues',
+        colorbar={'title': 'count'},
+        hovertemplate=x + '=%{x}<br>' + y + '=%{y}<br>count=%{z}<extra></extra>',
+    ))
+    sample = aggregate['sample']
+    if sample is not None:
+        fig.add_trace(go.Scattergl(
+            x=sample[x],
+            y=sample[y],
+            mode='markers',
+            marker={'size': 3, 'color': 'rgba(0, 0, 0, 0.4)'},
+            customdata=sample[hover_data].to_numpy(),
+            hovertemplate='<br>'.join(
+                ['{}=%{{{}}}'.format(x, 'x'), '{}=%{{{}}}'.format(y, 'y')]
+                + ['{}=%{{customdata[{}]}}'.format(name, i) for i, name in enumerate(hover_data)]
+            ) + '<extra></extra>',
+            showlegend=False,
+        ))
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+    return fig
+
+
+def sorted_stats(values, starts, counts):
+    """Return the count, min, quartiles and max of runs of `values`.
+
+    Run i holds the `counts[i]` values from `starts[i]` on, which are sorted.
+    The statistics are the same as those of a pandas groupby, with linearly
+    interpolated quartiles, and only read the values at a few positions of
+    every run.
+    """
+    def at(offset):
+        return values[starts + offset]
+
+    def quantile(q):
+        position = q * (counts - 1).astype('float64')
+        index = position.astype(np.int64)
+        fraction = position % 1
+        low = at(index).astype('float64')
+        high = at(np.minimum(index + 1, counts - 1)).astype('float64')
+        return np.where(fraction == 0, low, low + (high - low) * fraction)
+
+    # like pandas, the median of floats keeps their precision
+    median = (at((counts - 1) // 2).astype('float64') + at(counts // 2).astype('float64')) / 2
+    if values.dtype.kind == 'f':
+        median = median.astype(values.dtype)
+    return {
+        'count': counts,
+        'min': at(0),
+        'q1': quantile(0.25),
+        'median': median,
+        'q3': quantile(0.75),
+        'max': at(counts - 1),
+    }
+
+
+def stats_box_chart(stats, x, y, size=14):
+    """Return a min-max box plot drawn from precomputed statistics.
+
+    `stats` has a row for every group with its count, min, q1, median, q3
+    and max, as MarketCube.box_stats returns them, so the spec has the same
+    size however many listings there are. `x` is the name of the group
+    column of `stats` and `y` the name shown for the values.
+    """
+    tooltip = [alt.Tooltip(x, type='nominal')] + [alt.Tooltip(name, type='quantitative') for name in ['count', 'min', 'q1', 'median', 'q3', 'max']]
+    base = alt.Chart(stats).encode(x=alt.X(x, type='nominal', sort=list(stats[x])), tooltip=tooltip)
+    whisker = base.mark_rule().encode(y=alt.Y('min', type='quantitative', title=y), y2='max')
+    box = base.mark_bar(size=size).encode(y='q1:Q', y2='q3')
+    median = base.mark_tick(color='white', size=size).encode(y='median:Q')
+    return whisker + box + median
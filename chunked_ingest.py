@@ -0,0 +1,404 @@
+"""Cleaning of listing files too large to load at once.
+
+vehicle_data.load_vehicles reads the whole CSV before cleaning it, and the
+group medians used to fill missing values need whole groups. build_snapshot
+instead reads the CSV in chunks:
+
+1. The first pass keeps, for every column that is imputed, how often each of
+   its values occurs per group, and the values of the text columns. The
+   medians of every group are worked out from those counts.
+2. The columns in COUNT_RESOLUTION are counted in buckets of that size
+   instead, as most listings have a mileage of their own. Their counts only
+   tell which bucket holds the middle values of every group, so another pass
+   keeps the values in those buckets to find the exact medians.
+3. The last pass cleans one chunk at a time with those medians and appends
+   it to the Parquet snapshot, using the categories of the whole file.
+
+Only one chunk, the value counts and the values of the median buckets are
+held in memory. The counts grow with the number of groups and distinct
+values (or buckets) per group, not with the number of listings.
+
+The snapshot is the same as the one load_prepared writes from the in-memory
+cleaning, and is picked up by it as long as the CSV does not change.
+
+Run `python -m chunked_ingest [vehicles_us.csv] [rows per chunk]` to build it.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import vehicle_data
+
+
+CHUNK_ROWS = 100_000
+
+# imputed columns counted in buckets of this size, as they have about as
+# many values as listings; they cannot be the group key of an imputer
+COUNT_RESOLUTION = {'odometer': 100}
+
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS):
+    """Yield the raw listings of the CSV at `path`, `chunk_rows` rows at a time."""
+    return pd.read_csv(path, dtype=vehicle_data.CSV_DTYPES, chunksize=chunk_rows)
+
+
+def key_columns(imputers, i):
+    """Return the columns the values of imputer `i` have to be counted by.
+
+    Those are the columns it groups by, and the columns the imputers before
+    it need to fill any of those first.
+    """
+    columns = [key for by in imputers[i].groupings() for key in by]
+    for earlier in reversed(imputers[:i]):
+        if earlier.column in columns:
+            columns += [key for by in earlier.groupings() for key in by]
+    return list(dict.fromkeys(columns))
+
+
+def bucket(values, resolution):
+    """Return the start of the bucket of size `resolution` every one of `values` falls in."""
+    return np.floor(values / resolution) * resolution
+
+
+def encode(values, labels):
+    """Return the codes of a categorical column, NaN where it is missing.
+
+    `labels` maps every text value seen so far to its code and is extended
+    with the new ones, so the codes of all chunks agree.
+    """
+    codes = [labels.setdefault(label, len(labels)) for label in values.cat.categories]
+    return np.array(codes + [np.nan])[values.cat.codes.to_numpy()]
+
+
+def decode(index, labels):
+    """Return `index` with the codes of the text columns in `labels` replaced by their values."""
+    def values(level):
+        if level.name not in labels:
+            return level
+        return pd.Index(list(labels[level.name]), dtype=object, name=level.name)[level.to_numpy(dtype=np.intp)]
+    if isinstance(index, pd.MultiIndex):
+        return pd.MultiIndex.from_arrays([values(index.get_level_values(i)) for i in range(index.nlevels)])
+    return values(index)
+
+
+def chunk_values(chunk, columns, labels):
+    """Return `columns` of `chunk` as float arrays, text columns as their codes in `labels`."""
+    return [
+        encode(chunk[name], labels.setdefault(name, {}))
+        if isinstance(chunk[name].dtype, pd.CategoricalDtype) else chunk[name].to_numpy(dtype='float64', na_value=np.nan)
+        for name in columns
+    ]
+
+
+def group_starts(columns):
+    """Return the positions where the values of the sorted, equal length `columns` change.
+
+    Missing values count as equal to each other.
+    """
+    size = len(columns[0]) if columns else 0
+    changed = np.zeros(size, dtype=bool)
+    changed[:1] = True
+    for values in columns:
+        differs = values[1:] != values[:-1]
+        if values.dtype.kind == 'f':
+            differs &= ~(np.isnan(values[1:]) & np.isnan(values[:-1]))
+        changed[1:] |= differs
+    return np.flatnonzero(changed)
+
+
+class ValueCounts:
+    """How often each value of `column` occurs with each combination of `keys`.
+
+    Chunks are added one at a time. Missing values are counted too, as the
+    imputers need to know which groups they occur in. Text columns are
+    counted by their codes in the shared `labels`, and the counts of new
+    chunks are only added to the running total once they are as long as it,
+    so adding a chunk does not mean regrouping everything seen so far.
+    With a `resolution`, the values of `column` are counted by their bucket.
+    """
+
+    def __init__(self, column, keys, labels, resolution=None):
+        self.columns = list(dict.fromkeys(keys + [column]))
+        self.labels = labels
+        self.column = column
+        self.resolution = resolution
+        self.total = None
+        self.pending = []
+
+    def add(self, chunk):
+        values = chunk_values(chunk, self.columns, self.labels)
+        if self.resolution:
+            i = self.columns.index(self.column)
+            values[i] = bucket(values[i], self.resolution)
+        self.pending.append(self.reduce(values, np.ones(len(chunk), dtype=np.int64)))
+        if sum(len(n) for _, n in self.pending) >= (0 if self.total is None else len(self.total[1])):
+            self.merge()
+
+    def reduce(self, values, n):
+        """Return the distinct rows of the columns `values` and the sum of `n` for each."""
+        if not len(n):
+            return values, n
+        order = np.lexsort(values[::-1])
+        values = [column[order] for column in values]
+        starts = group_starts(values)
+        return [column[starts] for column in values], np.add.reduceat(n[order], starts)
+
+    def merge(self):
+        parts = ([] if self.total is None else [self.total]) + self.pending
+        values = [np.concatenate([part[0][i] for part in parts]) for i in range(len(self.columns))]
+        self.total = self.reduce(values, np.concatenate([part[1] for part in parts]))
+        self.pending = []
+
+    def frame(self):
+        """Return the counts as a frame of the key and value columns and their count `n`.
+
+        Text columns hold their codes.
+        """
+        if self.pending:
+            self.merge()
+        values, n = self.total or ([np.array([])] * len(self.columns), np.array([], dtype=np.int64))
+        return pd.DataFrame({**dict(zip(self.columns, values)), 'n': n})
+
+
+def median_ranks(counts, column, by):
+    """Return where the middle values of `column` are for every group of `by`, from a ValueCounts frame.
+
+    The result has a row for every group with a value: its keys, the values
+    `low` and `high` of the middle one or two listings (the same when there
+    is one), and `low_rank` and `high_rank`, the number of listings of the
+    group with that value before them.
+    """
+    counts = counts.dropna(subset=[column] + by)
+    keys = [counts[key].to_numpy() for key in by]
+    values = counts[column].to_numpy(dtype='float64')
+    order = np.lexsort([values] + keys[::-1])
+    keys = [key[order] for key in keys]
+    values, n = values[order], counts['n'].to_numpy()[order]
+    if len(n):
+        # the counts may be split by other keys, which are summed away here
+        runs = group_starts(keys + [values])
+        keys, values, n = [key[runs] for key in keys], values[runs], np.add.reduceat(n, runs)
+    starts = group_starts(keys) if by else np.array([0])[:len(n)]
+    ranks = pd.DataFrame({key: key_values[starts] for key, key_values in zip(by, keys)}, index=range(len(starts)))
+    if not len(n):
+        return ranks.assign(low=values, low_rank=n, high=values, high_rank=n)
+
+    # the middle one or two values of every group, counting each value n times
+    totals = np.add.reduceat(n, starts)
+    ends = np.cumsum(n)
+    before = ends - n
+    for name, middle in [('low', (totals - 1) // 2), ('high', totals // 2)]:
+        position = before[starts] + middle
+        at = np.searchsorted(ends, position, side='right')
+        ranks[name] = values[at]
+        ranks[name + '_rank'] = position - before[at]
+    return ranks
+
+
+def group_stats(ranks, by, stats):
+    """Return the `stats` of the groups of a median_ranks frame in the form GroupImputer.group_stats gives.
+
+    That is a Series indexed by the groups, or a single number when `by` is empty.
+    """
+    stats = np.asarray(stats, dtype='float64')
+    if not by:
+        return stats[0] if len(stats) else np.nan
+    if len(by) == 1:
+        groups = pd.Index(ranks[by[0]].to_numpy(), name=by[0])
+    else:
+        groups = pd.MultiIndex.from_arrays([ranks[key].to_numpy() for key in by], names=by)
+    return pd.Series(stats, index=groups)
+
+
+def median_from_counts(counts, column, by):
+    """Return the median of `column` for every group of `by`, from a ValueCounts frame.
+
+    The result has the same form as GroupImputer.group_stats with 'median'.
+    """
+    ranks = median_ranks(counts, column, by)
+    return group_stats(ranks, by, (ranks['low'] + ranks['high']) / 2)
+
+
+def fill_keys(frame, imputers, i, stats):
+    """Fill the missing keys of imputer `i` in `frame` with the imputers before it, which have `stats`."""
+    for earlier in imputers[:i]:
+        if earlier.column in frame and earlier.column != imputers[i].column:
+            frame[earlier.column] = earlier.transform(frame, stats[earlier.column])
+    return frame
+
+
+def fit_imputers(counts, imputers):
+    """Return the statistics of every imputer, in the form impute(..., stats) takes.
+
+    `counts` maps the column of every imputer to its ValueCounts frame. Imputers
+    run in order, so the group keys are first filled by the imputers before.
+    """
+    if any(imputer.stat != 'median' for imputer in imputers):
+        raise ValueError('chunked ingest only supports median imputation')
+    stats = {}
+    for i, imputer in enumerate(imputers):
+        frame = fill_keys(counts[imputer.column].copy(), imputers, i, stats)
+        stats[imputer.column] = {
+            tuple(by): median_from_counts(frame, imputer.column, by) for by in imputer.groupings()
+        }
+    return stats
+
+
+def exact_medians(path, counts, imputers, i, stats, labels, resolution, chunk_rows=CHUNK_ROWS):
+    """Return the exact medians of imputer `i`, whose values were counted in buckets of `resolution`.
+
+    `counts` is its ValueCounts frame, `stats` the statistics of the
+    imputers before it and `labels` the codes of the text columns. The
+    counts tell which bucket holds each middle value and how many values of
+    the group in that bucket come before it, so another pass over the CSV
+    at `path` only keeps the values in those buckets.
+    """
+    imputer = imputers[i]
+    column = imputer.column
+    frame = fill_keys(counts.copy(), imputers, i, stats)
+    wanted = {}
+    for by in imputer.groupings():
+        ranks = median_ranks(frame, column, by)
+        # the low middle value of every group is looked for as target i, the high one as target len(ranks) + i
+        targets = pd.DataFrame({key: np.tile(ranks[key].to_numpy(), 2) for key in by})
+        targets[column] = np.concatenate([ranks['low'], ranks['high']])
+        targets['target'] = np.arange(len(targets))
+        wanted[tuple(by)] = ranks, targets, [(np.array([], dtype=np.int64), np.array([]))]
+
+    columns = list(dict.fromkeys(key_columns(imputers, i) + [column]))
+    for chunk in read_chunks(path, chunk_rows):
+        values = pd.DataFrame(dict(zip(columns, chunk_values(chunk, columns, labels))))
+        values = fill_keys(values, imputers, i, stats)
+        values['value'] = values[column]
+        values[column] = bucket(values[column].to_numpy(), resolution)
+        for by, (_, targets, found) in wanted.items():
+            matched = values[list(by) + [column, 'value']].merge(targets, on=list(by) + [column])
+            found.append((matched['target'].to_numpy(), matched['value'].to_numpy()))
+
+    medians = {}
+    for by, (ranks, targets, found) in wanted.items():
+        target = np.concatenate([part[0] for part in found])
+        found_values = np.concatenate([part[1] for part in found])
+        order = np.lexsort([found_values, target])
+        target, found_values = target[order], found_values[order]
+        first = np.searchsorted(target, targets['target'].to_numpy())
+        middle = found_values[first + np.concatenate([ranks['low_rank'], ranks['high_rank']]).astype(np.intp)]
+        medians[by] = group_stats(ranks, list(by), (middle[:len(ranks)] + middle[len(ranks):]) / 2)
+    return medians
+
+
+def file_categories(values):
+    """Return the categories of the text columns of a file with the distinct `values` of each.
+
+    Those are the categories read_csv would give the whole file, and the
+    manufacturers of its models.
+    """
+    categories = {column: pd.Index(sorted(found)) for column, found in values.items()}
+    models = pd.Series(pd.Categorical(categories['model'], categories=categories['model']))
+    categories['manufacturer'] = vehicle_data.model_manufacturer(models).astype('category').cat.categories
+    return categories
+
+
+def scan(path, chunk_rows=CHUNK_ROWS, imputers=vehicle_data.IMPUTERS):
+    """Make the first pass over the CSV at `path`.
+
+    Returns the imputation statistics and the categories of every text
+    column of the cleaned listings. The medians of the columns in
+    COUNT_RESOLUTION take one more pass.
+    """
+    if any(key in COUNT_RESOLUTION for imputer in imputers for by in imputer.groupings() for key in by):
+        raise ValueError('a column counted in buckets cannot be a group key')
+    labels = {}
+    counts = [
+        ValueCounts(imputer.column, key_columns(imputers, i), labels, COUNT_RESOLUTION.get(imputer.column))
+        for i, imputer in enumerate(imputers)
+    ]
+    values = {column: set() for column in vehicle_data.CSV_DTYPES}
+    for chunk in read_chunks(path, chunk_rows):
+        for imputer_counts in counts:
+            imputer_counts.add(chunk)
+        for column in values:
+            values[column].update(chunk[column].cat.categories)
+
+    categories = file_categories(values)
+
+    # the statistics are worked out on the codes, and only their group keys are turned back into text
+    frames = {imputer.column: imputer_counts.frame() for imputer, imputer_counts in zip(imputers, counts)}
+    stats = fit_imputers(frames, imputers)
+    for i, imputer in enumerate(imputers):
+        if imputer.column in COUNT_RESOLUTION:
+            stats[imputer.column] = exact_medians(
+                path, frames[imputer.column], imputers, i, stats, labels, COUNT_RESOLUTION[imputer.column], chunk_rows)
+    for column_stats in stats.values():
+        for by, by_stats in column_stats.items():
+            if by:
+                by_stats.index = decode(by_stats.index, labels)
+    return stats, categories
+
+
+def clean_chunk(chunk, stats, categories, dtypes):
+    """Clean one chunk of raw listings the way the whole file would be cleaned."""
+    for column in vehicle_data.CSV_DTYPES:
+        chunk[column] = chunk[column].cat.set_categories(categories[column])
+    cleaned = vehicle_data.clean_vehicles(chunk, stats=stats)
+    cleaned['manufacturer'] = cleaned['manufacturer'].cat.set_categories(categories['manufacturer'])
+
+    # a column apply_schema keeps as float32 in any chunk is float32 in the whole file
+    widened = {
+        column: 'float32' for column, dtype in dtypes.items()
+        if np.dtype(dtype).kind == 'i' and cleaned[column].dtype == 'float32'
+    }
+    return cleaned.astype({**dtypes, **widened}), widened
+
+
+def write_pass(path, snapshot_path, source_hash, stats, categories, dtypes, chunk_rows=CHUNK_ROWS):
+    """Make the second pass, writing the cleaned chunks to `snapshot_path`.
+
+    Returns the integer columns that turned out to need float32 instead. In
+    that case nothing is written and the pass has to be made again.
+    """
+    tmp_path = '{}.{}.tmp'.format(snapshot_path, os.getpid())
+    writer = None
+    try:
+        for chunk in read_chunks(path, chunk_rows):
+            cleaned, widened = clean_chunk(chunk, stats, categories, dtypes)
+            if widened:
+                return widened
+            table = pa.Table.from_pandas(cleaned, preserve_index=False)
+            if writer is None:
+                schema = table.schema.with_metadata({**(table.schema.metadata or {}), **vehicle_data.snapshot_tag(source_hash)})
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_table(table.cast(writer.schema), row_group_size=vehicle_data.ROW_GROUP_ROWS)
+        if writer is None:
+            raise ValueError('{} has no listings'.format(path))
+        writer.close()
+        writer = None
+        os.replace(tmp_path, snapshot_path)
+        return {}
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def build_snapshot(path=vehicle_data.DATA_PATH, snapshot_path=vehicle_data.SNAPSHOT_PATH, chunk_rows=CHUNK_ROWS):
+    """Clean the CSV at `path` chunk by chunk into the snapshot at `snapshot_path`."""
+    source_hash = vehicle_data.file_hash(path)
+    stats, categories = scan(path, chunk_rows)
+    dtypes = dict(vehicle_data.NUMERIC_DTYPES)
+    while True:
+        widened = write_pass(path, snapshot_path, source_hash, stats, categories, dtypes, chunk_rows)
+        if not widened:
+            return
+        dtypes.update(widened)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else vehicle_data.DATA_PATH
+    chunk_rows = int(sys.argv[2]) if len(sys.argv) > 2 else CHUNK_ROWS
+    build_snapshot(path, os.path.splitext(path)[0] + '.parquet', chunk_rows)
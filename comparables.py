@@ -0,0 +1,80 @@
+"""Nearest neighbour search for listings similar to a given vehicle.
+
+ComparablesIndex keeps one KD-tree per model over the model year, mileage,
+condition and cylinders of its listings. Each feature is divided by its
+standard deviation over the whole dataset, so a difference of one standard
+deviation weighs the same in every feature. Finding the listings closest to a
+vehicle then only searches the tree of its model. The tree of a model is
+built the first time it is searched, so a new version of the listings only
+costs scaling the features and grouping them by model.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+FEATURES = ['model_year', 'odometer', 'condition', 'cylinders']
+
+# conditions from worst to best, used as the numeric value of the condition
+CONDITIONS = ['salvage', 'fair', 'good', 'excellent', 'like new', 'new']
+
+NEIGHBOURS = 10
+
+
+def condition_rank(condition):
+    """Return the position of every entry of `condition` in CONDITIONS (NaN if unknown)."""
+    ranks = pd.Series(condition).map({name: rank for rank, name in enumerate(CONDITIONS)})
+    return ranks.to_numpy(dtype='float64', na_value=np.nan)
+
+
+class ComparablesIndex:
+    """Per-model KD-trees over the scaled FEATURES of `data`."""
+
+    def __init__(self, data):
+        points = np.column_stack([
+            condition_rank(data[name]) if name == 'condition' else data[name].to_numpy(dtype='float64', na_value=np.nan)
+            for name in FEATURES
+        ])
+        scale = np.nanstd(points, axis=0) if len(points) else np.ones(len(FEATURES))
+        self.scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+        points = points / self.scale
+
+        # listings with a missing feature cannot be placed and are left out
+        complete = ~np.isnan(points).any(axis=1)
+        codes = data['model'].cat.codes.to_numpy()
+        positions = np.flatnonzero(complete & (codes >= 0))
+        positions = positions[np.argsort(codes[positions], kind='stable')]
+        starts = np.searchsorted(codes[positions], np.arange(len(data['model'].cat.categories) + 1))
+
+        self.points = points
+        self.models = data['model'].cat.categories
+        self.trees = {}
+        self.positions = {}
+        for code, model in enumerate(self.models):
+            rows = positions[starts[code]:starts[code + 1]]
+            if len(rows):
+                self.positions[model] = rows
+
+    def tree(self, model):
+        """Return the KD-tree of the listings of `model`, building it on first use."""
+        tree = self.trees.get(model)
+        if tree is None:
+            # sessions building the same tree at once get equal trees, so no lock is needed
+            tree = cKDTree(self.points[self.positions[model]])
+            self.trees[model] = tree
+        return tree
+
+    def nearest(self, model, model_year, odometer, condition, cylinders, n=NEIGHBOURS):
+        """Return the row positions of the `n` listings of `model` closest to the vehicle.
+
+        Also returns their distances in scaled units, closest first. A model
+        without listings gives empty arrays.
+        """
+        if model not in self.positions:
+            return np.array([], dtype=np.intp), np.array([])
+        point = np.array([model_year, odometer, condition_rank([condition])[0], cylinders], dtype='float64') / self.scale
+        tree = self.tree(model)
+        k = min(n, tree.n)
+        distances, found = tree.query(point, k=k)
+        distances, found = np.atleast_1d(distances), np.atleast_1d(found)
+        return self.positions[model][found], distances
@@ -0,0 +1,121 @@
+"""Paged tables of the listings that are sorted on the server.
+
+st.dataframe sends every row it is given to the browser. The tables here only
+send the page being looked at; sorting and paging happen on the shared
+listings using sort orders that are computed once, and the page is asked for
+through the queries of query_service.py.
+"""
+import copy
+import math
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import filter_index
+import instrumentation
+import sections
+
+
+PAGE_SIZE = 50
+SORT_COLUMNS = ['price', 'model_year', 'model', 'condition', 'odometer', 'type', 'manufacturer', 'days_listed', 'date_posted']
+
+
+def sort_values(values):
+    """Return the values of a column to sort on: the codes of a categorical, in category order."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.codes
+    return values.to_numpy()
+
+
+class SortIndex:
+    """The sorted row order of the common sort columns of `data`."""
+
+    def __init__(self, data, columns=SORT_COLUMNS):
+        self.size = len(data)
+        self.columns = list(columns)
+        self.orders = {}
+        self.ranks = {}
+        for name in self.columns:
+            self.set_order(name, np.argsort(sort_values(data[name]), kind='stable'))
+
+    def set_order(self, name, order):
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        self.orders[name] = order
+        self.ranks[name] = rank
+
+    def updated(self, data, rows):
+        """Return the sort index of `data`, the listings this index was built on with changes.
+
+        `rows` are the positions of the rows added at the end of `data` and of
+        the rows whose values changed; only those are placed in the orders again.
+        """
+        index = copy.copy(self)
+        index.size = len(data)
+        index.orders = {}
+        index.ranks = {}
+        for name in self.columns:
+            # categories are kept in order when new ones are added, so the old order stays valid
+            index.set_order(name, filter_index.merge_order(self.orders[name], sort_values(data[name]), rows))
+        return index
+
+    def page(self, rows=None, by=None, descending=False, page=0, page_size=PAGE_SIZE):
+        """Return the row positions shown on `page` (counting from 0).
+
+        `rows` are the sorted positions of the selected rows, or None for all
+        of them, and `by` is the column to sort on, or None for listing order.
+        Only a selection of rows needs sorting; the full table is read
+        straight from the precomputed order.
+        """
+        total = self.size if rows is None else len(rows)
+        start = min(page * page_size, total)
+        stop = min(start + page_size, total)
+        if descending:
+            start, stop = total - stop, total - start
+
+        if rows is None and by is None:
+            positions = np.arange(start, stop)
+        elif rows is None:
+            positions = self.orders[by][start:stop]
+        elif by is None:
+            positions = rows[start:stop]
+        else:
+            positions = rows[np.argsort(self.ranks[by][rows], kind='stable')][start:stop]
+        return positions[::-1] if descending else positions
+
+
+def show_table(queries, version, key='table', page_size=PAGE_SIZE, **where):
+    """Show the listings matching `where` one page at a time.
+
+    `queries` is a query_service.LocalQueries or QueryClient, and `where`
+    holds the filters of its select method (new_only, equals and ranges).
+    `key` keeps the widgets of different tables on the page apart. The size
+    of the table and the page shown are kept for the session (see
+    sections.py) until `version`, the fingerprint of the listings, the
+    filters or the table's own widgets change.
+    """
+    def summary():
+        with queries.batch() as batch:
+            found = batch.count(**where)
+            all_columns = batch.columns()
+            sort_columns = batch.sort_columns()
+        return found.result(), all_columns.result(), sort_columns.result()
+
+    total, all_columns, sort_columns = sections.run(key + ' table', (version, where), summary)
+    pages = max(1, math.ceil(total / page_size))
+
+    columns = st.multiselect('Columns', all_columns, default=all_columns, key=key + '_columns')
+    sort_col, order_col, page_col = st.columns([2, 1, 1])
+    by = sort_col.selectbox('Sort by', [None] + sort_columns, format_func=lambda name: name or 'listing order', key=key + '_sort')
+    descending = order_col.checkbox('Descending', key=key + '_descending')
+    page = page_col.number_input('Page (of {:,})'.format(pages), min_value=1, max_value=pages, value=1, step=1, key=key + '_page')
+    page = min(int(page), pages) - 1
+
+    shown = sections.run(
+        key + ' page', (version, where, by, descending, page, page_size, tuple(columns)),
+        lambda: queries.table_page(by=by, descending=descending, page=page, page_size=page_size, columns=columns, **where))
+    instrumentation.payload(key + ' table', shown)
+    st.dataframe(shown)
+    first = page * page_size
+    st.caption('Showing {:,} - {:,} of {:,} vehicles'.format(min(first + 1, total), first + len(shown), total))
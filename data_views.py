@@ -0,0 +1,98 @@
+"""Reading only the columns and rows a view of the app needs.
+
+Every chart or index of the app uses a few columns of the listings, and some
+only a part of the rows. A View declares those, and a source reads them:
+
+- FrameSource applies the view to a frame already in memory. The app keeps
+  the whole cleaned frame for its tables and indexes, so its views are read
+  from it rather than from disk: this is the only source the app uses.
+- SnapshotSource reads the Parquet snapshot, for tools that do not hold the
+  listings in memory. Only the declared columns are read, and row groups
+  whose statistics rule out the filters are skipped. The file is opened once
+  and every view is read from that file, even if the snapshot is replaced
+  later. benchmarks/bench_pipeline.py times both, the snapshot as snapshot:*.
+
+Both return a new frame with the rows in the order of the listings.
+"""
+import operator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import vehicle_data
+
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class View:
+    """The `columns` a part of the app reads and the `filters` its rows must pass.
+
+    `filters` is a list of (column, op, value) tuples that must all hold, with
+    op one of OPERATORS or 'in' (value is then a list).
+    """
+
+    def __init__(self, columns, filters=()):
+        self.columns = list(columns)
+        self.filters = [tuple(condition) for condition in filters]
+
+    def __repr__(self):
+        return 'View({!r}, filters={!r})'.format(self.columns, self.filters)
+
+    def where(self, *filters):
+        """Return this view with `filters` added."""
+        return View(self.columns, self.filters + list(filters))
+
+
+def condition(values, op, value):
+    """Return `values op value`, for pyarrow expressions and pandas Series alike."""
+    if op == 'in':
+        return values.isin(value)
+    return OPERATORS[op](values, value)
+
+
+class SnapshotSource:
+    """Views read from the Parquet snapshot at `path`, as it is when the source is made.
+
+    With `source_hash`, the file opened must be the snapshot of that CSV
+    (see vehicle_data.snapshot_tag), or ValueError is raised. The file stays
+    mapped, so a snapshot written over it afterwards is not read.
+    """
+
+    def __init__(self, path=vehicle_data.SNAPSHOT_PATH, source_hash=None):
+        self.path = path
+        self.fragment = ds.ParquetFileFormat().make_fragment(pa.memory_map(path))
+        if source_hash is not None:
+            metadata = self.fragment.physical_schema.metadata or {}
+            if any(metadata.get(key) != value for key, value in vehicle_data.snapshot_tag(source_hash).items()):
+                raise ValueError('{} is not the snapshot of {}'.format(path, source_hash))
+
+    def read(self, view):
+        expression = None
+        for column, op, value in view.filters:
+            term = condition(ds.field(column), op, value)
+            expression = term if expression is None else expression & term
+        return self.fragment.to_table(columns=view.columns, filter=expression).to_pandas()
+
+
+class FrameSource:
+    """Views read from the frame `data` in memory."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, view):
+        if not view.filters:
+            return self.data[view.columns].reset_index(drop=True)
+        mask = pd.Series(True, index=self.data.index)
+        for column, op, value in view.filters:
+            mask &= condition(self.data[column], op, value)
+        return self.data.loc[mask.to_numpy(), view.columns].reset_index(drop=True)
@@ -0,0 +1,81 @@
+"""A bounded cache of built charts shared by every session of the app.
+
+The charts only depend on the dataset version and a few widget values, and
+most visitors look at the same default selections. FigureCache keeps the most
+recently used charts so those are built once and then reused, and drops them
+all when the dataset changes.
+"""
+import threading
+from collections import OrderedDict
+
+
+MAX_ENTRIES = 256
+
+
+class FigureCache:
+    """Least recently used cache of figures with hit and miss counters.
+
+    Figures handed out are shared between sessions and must not be modified.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_or_build(self, key, build):
+        """Return the figure cached under `key`, calling `build()` to make it if needed.
+
+        `key` must be hashable and include everything the figure depends on,
+        for example the dataset fingerprint and the widget values.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        # build outside the lock so other charts are not held up; two sessions
+        # missing the same key at once both build it and the last one is kept
+        figure = build()
+        with self.lock:
+            self.entries[key] = figure
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return figure
+
+    def use_version(self, version):
+        """Clear the cache when the dataset `version` (its fingerprint) is not the one seen last.
+
+        The keys of the figures built on older data can no longer come up.
+        """
+        with self.lock:
+            changed = version != self.version
+            self.version = version
+        if changed:
+            self.clear()
+
+    def stats(self):
+        """Return the size of the cache and its hit, miss and eviction counts."""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
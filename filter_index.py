@@ -0,0 +1,246 @@
+"""Precomputed indexes for the search filters of the app.
+
+Scanning whole columns for every widget change costs time proportional to the
+size of the inventory. FilterIndex is built once over the shared listings and
+answers the filters from
+
+- a sorted array of row positions for every value of a categorical column, and
+- the row order of every range column, so a range is found by binary search.
+
+A query starts from whichever predicate matches the fewest rows and checks the
+remaining predicates only on those rows, so its cost follows the size of the
+smallest match rather than the size of the table.
+"""
+import copy
+
+import numpy as np
+import pandas as pd
+
+
+EQUALS_COLUMNS = ['type', 'manufacturer', 'condition', 'age_category', 'list_age_category']
+RANGE_COLUMNS = ['price', 'days_listed']
+
+
+def precedes(keys, first, second):
+    """Return whether rows `first` sort before rows `second` by `keys` and then by position.
+
+    Missing values sort last, as in np.argsort.
+    """
+    before = first < second
+    for values in keys[::-1]:
+        a, b = values[first], values[second]
+        less, equal = a < b, a == b
+        if values.dtype.kind == 'f':
+            less |= ~np.isnan(a) & np.isnan(b)
+            equal |= np.isnan(a) & np.isnan(b)
+        before = less | (equal & before)
+    return before
+
+
+def merge_order(order, keys, rows):
+    """Return the stable sorted order of the rows by `keys` after the entries at `rows` changed.
+
+    `keys` is an array, or a list of arrays to sort by one after the other.
+    `order` is the stable sorted order before, which may be shorter than the
+    keys when rows were added at the end; `rows` holds the positions of the
+    added rows and of the rows whose keys changed. Only those are placed
+    again, by binary search, so the work besides copying the order is
+    proportional to their number.
+    """
+    keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+    rows = np.unique(np.asarray(rows, dtype=np.intp))
+    placed = np.zeros(len(keys[0]), dtype=bool)
+    placed[rows] = True
+    keep = order[~placed[order]]
+    kept_values = keys[0][keep]
+
+    # find the run of kept rows with the same first key, then bisect it by
+    # the other keys and the position, as a stable sort orders equal keys
+    rows = rows[np.lexsort([rows] + [values[rows] for values in keys[::-1]])]
+    low = np.searchsorted(kept_values, keys[0][rows], side='left')
+    high = np.searchsorted(kept_values, keys[0][rows], side='right')
+    while (low < high).any():
+        search = low < high
+        middle = (low + high) // 2
+        before = search & precedes(keys[1:], keep[np.minimum(middle, len(keep) - 1)], rows)
+        low = np.where(before, middle + 1, low)
+        high = np.where(search & ~before, middle, high)
+    return np.insert(keep, low, rows)
+
+
+class GroupOrder:
+    """The rows ordered by their group and then by their value.
+
+    The values of every group form a sorted run, so order statistics of a
+    group are read off by position. `groups` are integer group numbers, and
+    rows in group -1 belong to none.
+    """
+
+    def __init__(self, groups, values):
+        self.set_order(np.lexsort([values, groups]), groups, values)
+
+    def set_order(self, order, groups, values):
+        self.order = order
+        self.sorted_groups = groups[order]
+        self.sorted_values = values[order]
+
+    def updated(self, groups, values, rows):
+        """Return the order after the rows at `rows` were added or changed group or value."""
+        group_order = copy.copy(self)
+        group_order.set_order(merge_order(self.order, [groups, values], rows), groups, values)
+        return group_order
+
+    def bounds(self, groups):
+        """Return where the run of every group of `groups` starts and stops."""
+        return np.searchsorted(self.sorted_groups, groups, side='left'), np.searchsorted(self.sorted_groups, groups, side='right')
+
+
+class FilterIndex:
+    """Equality and range indexes over the columns of `data`."""
+
+    def __init__(self, data, equals_columns=EQUALS_COLUMNS, range_columns=RANGE_COLUMNS):
+        self.values = {}
+        self.codes = {}
+        self.postings = {}
+        self.order = {}
+        self.sorted_values = {}
+
+        for name in equals_columns:
+            values = data[name]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            codes = values.cat.codes.to_numpy()
+            # stable sort keeps the row positions of every value in order
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(values.cat.categories) + 1))
+            self.values[name] = codes
+            self.codes[name] = {value: code for code, value in enumerate(values.cat.categories)}
+            self.postings[name] = [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        for name in range_columns:
+            values = data[name].to_numpy()
+            order = np.argsort(values, kind='stable')
+            self.values[name] = values
+            self.order[name] = order
+            self.sorted_values[name] = values[order]
+
+    def updated(self, data, rows):
+        """Return the index of `data`, the listings this index was built on with changes.
+
+        `rows` are the positions of the rows added at the end of `data` and of
+        the rows whose values changed. Only the postings and row orders those
+        rows are in are rebuilt; everything else is shared with this index.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        index = copy.copy(self)
+        index.values = dict(self.values)
+        index.codes = dict(self.codes)
+        index.postings = dict(self.postings)
+        index.order = dict(self.order)
+        index.sorted_values = dict(self.sorted_values)
+
+        for name in self.postings:
+            values = data[name]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            if list(values.cat.categories) != list(self.codes[name]):
+                # new values renumber every code, so the column is indexed again
+                rebuilt = FilterIndex(data, equals_columns=[name], range_columns=[])
+                for attribute in ('values', 'codes', 'postings'):
+                    getattr(index, attribute)[name] = getattr(rebuilt, attribute)[name]
+                continue
+            codes = values.cat.codes.to_numpy()
+            old_codes = self.values[name]
+            old = np.unique(rows[rows < len(old_codes)])
+            added = np.unique(rows)
+            postings = list(self.postings[name])
+            for code in np.unique(np.concatenate([old_codes[old], codes[added]])):
+                if code < 0:
+                    continue
+                # postings are sorted, so rows are taken out and put in by binary search
+                posting = postings[code]
+                leaving = old[old_codes[old] == code]
+                posting = np.delete(posting, np.searchsorted(posting, leaving))
+                joining = added[codes[added] == code]
+                postings[code] = np.insert(posting, np.searchsorted(posting, joining), joining)
+            index.values[name] = codes
+            index.postings[name] = postings
+
+        for name in self.order:
+            values = data[name].to_numpy()
+            order = merge_order(self.order[name], values, rows)
+            index.values[name] = values
+            index.order[name] = order
+            index.sorted_values[name] = values[order]
+        return index
+
+    def equal_rows(self, name, value):
+        """Return the sorted positions of the rows where column `name` is `value`."""
+        code = self.codes[name].get(value)
+        if code is None:
+            return np.array([], dtype=np.intp)
+        return self.postings[name][code]
+
+    def range_bounds(self, name, low=None, high=None):
+        """Return the slice of the row order of `name` holding values in [low, high]."""
+        sorted_values = self.sorted_values[name]
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+        stop = len(sorted_values) if high is None else np.searchsorted(sorted_values, high, side='right')
+        return start, max(start, stop)
+
+    def range_rows(self, name, low=None, high=None):
+        """Return the sorted positions of the rows where column `name` is in [low, high]."""
+        start, stop = self.range_bounds(name, low, high)
+        return np.sort(self.order[name][start:stop])
+
+    def query(self, equals=None, ranges=None, rows=None):
+        """Return the sorted positions of the rows matching every predicate.
+
+        `equals` maps columns to the value they must have, `ranges` maps
+        columns to inclusive (low, high) bounds where None means unbounded,
+        and `rows` (sorted positions, or None for all rows) restricts the
+        result further. Returns None when there is nothing to filter on.
+        """
+        equals = equals or {}
+        ranges = ranges or {}
+
+        # estimate how many rows each predicate matches
+        sizes = {}
+        for name, value in equals.items():
+            sizes[('equals', name)] = len(self.equal_rows(name, value))
+        for name, (low, high) in ranges.items():
+            start, stop = self.range_bounds(name, low, high)
+            sizes[('range', name)] = stop - start
+        if rows is not None:
+            sizes[('rows', None)] = len(rows)
+        if not sizes:
+            return None
+
+        # start from the most selective predicate ...
+        kind, name = min(sizes, key=sizes.get)
+        if kind == 'equals':
+            result = self.equal_rows(name, equals[name])
+        elif kind == 'range':
+            result = self.range_rows(name, *ranges[name])
+        else:
+            result = rows
+
+        # ... and check the others only on the rows it matched
+        for other, value in equals.items():
+            if (kind, name) != ('equals', other):
+                result = result[self.values[other][result] == self.codes[other].get(value, -2)]
+        for other, (low, high) in ranges.items():
+            if (kind, name) != ('range', other):
+                values = self.values[other][result]
+                keep = np.ones(len(result), dtype=bool)
+                if low is not None:
+                    keep &= values >= low
+                if high is not None:
+                    keep &= values <= high
+                result = result[keep]
+        if rows is not None and kind != 'rows':
+            if not len(rows):
+                return rows
+            found = np.searchsorted(rows, result)
+            result = result[(found < len(rows)) & (rows[np.minimum(found, len(rows) - 1)] == result)]
+        return result
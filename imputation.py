@@ -0,0 +1,77 @@
+"""Group statistic imputation used by the cleaning pipeline.
+
+`groupby(...).transform(lambda x: x.fillna(x.median()))` calls back into
+Python once per group. GroupImputer computes the statistic for every group in
+one vectorized groupby and then fills the missing rows by looking their keys
+up in the result.
+"""
+import pandas as pd
+
+
+class GroupImputer:
+    """Fill missing values of `column` with a statistic of its group.
+
+    `by` lists the grouping columns and `stat` is any groupby aggregation name
+    ('median', 'mean', ...). `fallback` is a list of coarser groupings tried, in
+    order, for rows whose group has no values at all; an empty grouping means
+    the statistic over the whole column.
+    """
+
+    def __init__(self, column, by, stat='median', fallback=()):
+        self.column = column
+        self.by = list(by)
+        self.stat = stat
+        self.fallback = [list(keys) for keys in fallback]
+
+    def __repr__(self):
+        return 'GroupImputer({!r}, by={!r}, stat={!r}, fallback={!r})'.format(
+            self.column, self.by, self.stat, self.fallback)
+
+    def group_stats(self, data, by=None):
+        """Return the statistic of `column` for every group of `by`."""
+        by = self.by if by is None else by
+        values = data[self.column]
+        if not by:
+            return values.agg(self.stat)
+        return values.groupby([data[key] for key in by], observed=True, sort=False).agg(self.stat)
+
+    def lookup(self, stats, data, by):
+        """Return the entries of `stats` for the keys of every row of `data`."""
+        if not by:
+            return pd.Series(stats, index=data.index, dtype='float64')
+        if len(by) == 1:
+            keys = pd.Index(data[by[0]])
+        else:
+            keys = pd.MultiIndex.from_arrays([data[key] for key in by])
+        return pd.Series(stats.reindex(keys).to_numpy(), index=data.index)
+
+    def groupings(self):
+        """Return the grouping and its fallbacks, in the order they are tried."""
+        return [self.by] + self.fallback
+
+    def transform(self, data, stats=None):
+        """Return `column` of `data` with its missing values filled.
+
+        `stats` optionally maps every grouping (as a tuple) to statistics
+        computed beforehand, for example over a whole file read in chunks.
+        Without it the statistics are computed from `data`.
+        """
+        result = data[self.column].copy()
+        for by in self.groupings():
+            missing = result.isna()
+            if not missing.any():
+                break
+            by_stats = self.group_stats(data, by) if stats is None else stats[tuple(by)]
+            result[missing] = self.lookup(by_stats, data[missing], by)
+        return result
+
+
+def impute(data, imputers, stats=None):
+    """Apply `imputers` to `data` in order, updating it in place.
+
+    `stats` optionally maps the column of every imputer to its precomputed
+    statistics (see GroupImputer.transform).
+    """
+    for imputer in imputers:
+        data[imputer.column] = imputer.transform(data, None if stats is None else stats[imputer.column])
+    return data
@@ -0,0 +1,418 @@
+"""Refreshing the listings when new ones are appended to the CSV.
+
+Rebuilding everything when a few listings are added to the end of the CSV
+costs as much as the first load. ListingFeed instead reads only the appended
+bytes and brings the previous version of the listings up to date:
+
+- New listings are cleaned like the rest, but the group medians that fill
+  their missing numbers are those of the whole file. ImputationState keeps
+  the medians of every group and recomputes only those of the groups the new
+  listings join. Earlier listings filled from a median that moved are
+  filled again, as a rebuild would.
+- The filter and sort indexes and the market cube place the new and refilled
+  listings into what they already hold (see their `updated` methods).
+
+The result is the same as cleaning the whole file again. What is left
+proportional to the size of the file is copying arrays: appending to the
+columns and row orders, and recoding a text column whose categories gained a
+value. The comparable listings are scaled by the spread of the whole file,
+so their features are scaled again and their trees are rebuilt when used.
+
+Every refresh makes new objects, so a session still using the previous
+version is not affected.
+"""
+import copy
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import chunked_ingest
+import comparables
+import data_viewer
+import data_views
+import filter_index
+import instrumentation
+import market_cube
+import vehicle_data
+
+
+# The last bytes of the CSV read so far. The file is taken to have been
+# appended to when they are still in place and the file is longer.
+TAIL_BYTES = 1 << 16
+
+class Groups:
+    """Ids of the groups of the `by` columns, and the values of every group in order.
+
+    Every combination of values gets an id the first time it is seen; rows
+    with a missing key have id -1. The rows with a value are kept ordered by
+    group and value, so the median of a group is read off by position.
+    """
+
+    def __init__(self, by):
+        self.by = list(by)
+        self.keys = None
+        self.ids = np.array([], dtype=np.int64)
+        self.valued_ids = self.ids
+        self.order = filter_index.GroupOrder(self.ids, np.array([]))
+
+    def key_index(self, keys):
+        columns = [keys[name].to_numpy() for name in self.by]
+        if len(columns) == 1:
+            return pd.Index(columns[0])
+        return pd.MultiIndex.from_arrays(columns)
+
+    def assign(self, keys, rows, values):
+        """Put `rows` in the groups of their `keys` (a frame of the `by` columns).
+
+        `values` are the values of all rows there are now. Returns the ids of
+        the groups `rows` were in before (-1 for new rows) and are in now.
+        """
+        ids = np.full(len(rows), -1, dtype=np.int64)
+        known = keys[self.by].notna().all(axis=1).to_numpy()
+        index = self.key_index(keys[known])
+        if self.keys is None:
+            self.keys = index[:0]
+        found = self.keys.get_indexer(index)
+        if (found < 0).any():
+            unseen = index[found < 0].unique()
+            self.keys = self.keys.append(unseen)
+            found = self.keys.get_indexer(index)
+        ids[known] = found
+
+        added = np.full(len(values) - len(self.ids), -1, dtype=np.int64)
+        before = np.concatenate([self.ids, added])[rows]
+        self.ids = np.concatenate([self.ids, added])
+        self.ids[rows] = ids
+        self.valued_ids = np.concatenate([self.valued_ids, added])
+        self.valued_ids[rows] = np.where(np.isnan(values[rows]), -1, ids)
+        self.order = self.order.updated(self.valued_ids, values, rows)
+        return before, ids
+
+    def medians(self, groups):
+        """Return the median of the values of every group of `groups`, NaN for those without any."""
+        starts, stops = self.order.bounds(groups)
+        counts = stops - starts
+        values = self.order.sorted_values
+        medians = np.full(len(groups), np.nan)
+        present = counts > 0
+        starts, counts = starts[present], counts[present]
+        medians[present] = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+        return medians
+
+
+class ImputationState:
+    """The raw values and group medians the `imputers` fill missing values from.
+
+    Listings are added in chunks. Only median imputation is supported, like
+    in chunked_ingest.
+    """
+
+    def __init__(self, imputers=vehicle_data.IMPUTERS):
+        if any(imputer.stat != 'median' for imputer in imputers):
+            raise ValueError('incremental refresh only supports median imputation')
+        self.imputers = imputers
+        self.size = 0
+        self.raw = {}
+        self.filled = {}
+        self.missing = {}
+        self.groups = {}
+        self.medians = {}
+        self.present = {}
+        for imputer in imputers:
+            self.raw[imputer.column] = np.array([])
+            self.filled[imputer.column] = np.array([])
+            self.missing[imputer.column] = np.array([], dtype=np.intp)
+            for by in imputer.groupings():
+                if by:
+                    self.groups[imputer.column, tuple(by)] = Groups(by)
+                    self.medians[imputer.column, tuple(by)] = np.array([])
+                else:
+                    self.present[imputer.column] = np.array([])
+
+    def keys(self, names, chunk, data, rows, start):
+        """Return the current values of the key columns `names` for `rows`.
+
+        Keys filled by an imputer come from the filled values, text keys from
+        `data` (the listings before `start`) or from `chunk` (the ones after).
+        """
+        old = rows < start
+        keys = {}
+        for name in names:
+            if name in self.filled:
+                keys[name] = self.filled[name][rows]
+            else:
+                keys[name] = np.concatenate([
+                    np.array([], dtype=object) if data is None else data[name].iloc[rows[old]].to_numpy(dtype=object),
+                    chunk[name].iloc[rows[~old] - start].to_numpy(dtype=object),
+                ])
+        return pd.DataFrame(keys)
+
+    def update_medians(self, column, by, keys, rows, size):
+        """Return the medians of `column` by `by` after `rows` were added or changed their keys.
+
+        The result has the form GroupImputer.group_stats gives.
+        """
+        raw = self.raw[column]
+        if not by:
+            added = np.sort(raw[self.size:size][~np.isnan(raw[self.size:size])])
+            present = np.insert(self.present[column], np.searchsorted(self.present[column], added), added)
+            self.present[column] = present
+            return (present[(len(present) - 1) // 2] + present[len(present) // 2]) / 2 if len(present) else np.nan
+
+        groups = self.groups[column, tuple(by)]
+        before, after = groups.assign(keys, rows, raw)
+
+        # only the groups a listing with a value left or joined can have a new median
+        valued = ~np.isnan(raw[rows])
+        affected = np.unique(np.concatenate([before[valued], after[valued]]))
+        affected = affected[affected >= 0]
+        medians = self.medians[column, tuple(by)]
+        medians = np.concatenate([medians, np.full(len(groups.keys) - len(medians), np.nan)])
+        medians[affected] = groups.medians(affected)
+        self.medians[column, tuple(by)] = medians
+        return pd.Series(medians, index=groups.keys)
+
+    def add(self, chunk, data=None):
+        """Add the raw listings `chunk` after the ones added before.
+
+        `data` holds the text key columns of the listings added before, for
+        which the cleaned listings will do. Returns the medians in the form
+        impute(..., stats) takes, and maps every imputed column to the
+        positions of the earlier listings filled with a different value and
+        those values.
+        """
+        start, size = self.size, self.size + len(chunk)
+        new = np.arange(start, size)
+        stats = {}
+        changed = {}
+        for imputer in self.imputers:
+            column = imputer.column
+            values = chunk[column].to_numpy(dtype='float64', na_value=np.nan)
+            self.raw[column] = np.concatenate([self.raw[column], values])
+            self.missing[column] = np.concatenate([self.missing[column], new[np.isnan(values)]])
+
+            # the new listings and the ones with a key filled differently may be in other groups
+            keyed = list(dict.fromkeys(key for by in imputer.groupings() for key in by))
+            moved = np.unique(np.concatenate([new] + [changed[key][0] for key in keyed if key in changed]))
+            keys = self.keys(keyed, chunk, data, moved, start)
+            stats[column] = {tuple(by): self.update_medians(column, by, keys, moved, size) for by in imputer.groupings()}
+
+            # fill every missing value again, as GroupImputer.transform does
+            rows = self.missing[column]
+            fill = np.full(len(rows), np.nan)
+            for by in imputer.groupings():
+                need = np.isnan(fill)
+                if not need.any():
+                    break
+                if by:
+                    medians = np.append(self.medians[column, tuple(by)], np.nan)
+                    fill[need] = medians[self.groups[column, tuple(by)].ids[rows[need]]]
+                else:
+                    fill[need] = stats[column][()]
+            filled = np.concatenate([self.filled[column], values])
+            filled[rows] = fill
+
+            old = rows[rows < start]
+            before, after = self.filled[column][old], filled[old]
+            differs = (before != after) & ~(np.isnan(before) & np.isnan(after))
+            if differs.any():
+                changed[column] = old[differs], after[differs]
+            self.filled[column] = filled
+        self.size = size
+        return stats, changed
+
+
+def set_rows(data, column, rows, values):
+    """Set `column` of `data` to `values` at the positions `rows`."""
+    current = data[column]
+    if isinstance(current.dtype, pd.CategoricalDtype):
+        codes = current.cat.codes.to_numpy().copy()
+        codes[rows] = pd.Categorical(values, dtype=current.dtype).codes
+        data[column] = pd.Categorical.from_codes(codes, dtype=current.dtype)
+    else:
+        array = current.to_numpy(dtype='float64', copy=True)
+        array[rows] = values
+        data[column] = array
+
+
+def combine(data, cleaned, changed):
+    """Return `data` with the `cleaned` listings appended and the refilled values of `changed`.
+
+    `changed` is the second result of ImputationState.add. The result has the
+    dtypes and categories cleaning the whole file would give. Also returns
+    the positions of the new and changed listings.
+    """
+    data = data.copy(deep=False)
+    for column in data.columns:
+        dtype = cleaned[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype) and not data[column].cat.categories.equals(dtype.categories):
+            data[column] = data[column].cat.set_categories(dtype.categories)
+    combined = pd.concat([data, cleaned], ignore_index=True)
+
+    positions = [np.arange(len(data), len(combined))]
+    for column, (rows, values) in changed.items():
+        if column == 'model_year':
+            # the same steps clean_vehicles takes after filling it
+            values = values.astype(int)
+            ages = vehicle_data.CURRENT_YEAR - values
+            set_rows(combined, 'age', rows, ages)
+            set_rows(combined, 'age_category', rows, vehicle_data.bucketize(ages, vehicle_data.AGE_BUCKETS))
+        set_rows(combined, column, rows, values)
+        positions.append(rows)
+
+    # an integer column stays float32 only while it holds a fraction somewhere
+    numeric = [
+        column for column, dtype in vehicle_data.NUMERIC_DTYPES.items()
+        if column in combined and combined[column].dtype != dtype
+    ]
+    schema = vehicle_data.apply_schema(combined[numeric].copy())
+    for column in numeric:
+        combined[column] = schema[column]
+    return combined, np.unique(np.concatenate(positions))
+
+
+class Listings:
+    """One version of the cleaned listings and the indexes the app builds from them."""
+
+    def __init__(self, fingerprint, source_hash, data):
+        self.fingerprint = fingerprint
+        self.source_hash = source_hash
+        self.data = data
+        with instrumentation.timed('index:filter'):
+            self.index = filter_index.FilterIndex(data)
+        with instrumentation.timed('index:sort'):
+            self.sort_index = data_viewer.SortIndex(data)
+        # the whole frame is kept for the tables, so the views are read from it too
+        self.source = data_views.FrameSource(data)
+        with instrumentation.timed('index:market_cube'):
+            self.cube = market_cube.MarketCube(data)
+        with instrumentation.timed('index:comparables'):
+            self.comparables = comparables.ComparablesIndex(data)
+
+    def updated(self, fingerprint, source_hash, data, rows):
+        """Return the version of `data`, these listings with the listings at `rows` added or changed."""
+        listings = copy.copy(self)
+        listings.fingerprint = fingerprint
+        listings.source_hash = source_hash
+        listings.data = data
+        with instrumentation.timed('index:filter'):
+            listings.index = self.index.updated(data, rows)
+        with instrumentation.timed('index:sort'):
+            listings.sort_index = self.sort_index.updated(data, rows)
+        listings.source = data_views.FrameSource(data)
+        with instrumentation.timed('index:market_cube'):
+            listings.cube = self.cube.updated(data, rows)
+        with instrumentation.timed('index:comparables'):
+            listings.comparables = comparables.ComparablesIndex(data)
+        return listings
+
+
+class ListingFeed:
+    """The Listings of the CSV at `path`, kept up to date as listings are appended to it."""
+
+    def __init__(self, path=vehicle_data.DATA_PATH, snapshot_path=vehicle_data.SNAPSHOT_PATH, imputers=vehicle_data.IMPUTERS):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.imputers = imputers
+        self.lock = threading.Lock()
+        self.listings = None
+
+        # the bytes of the CSV the listings were built from
+        self.size = 0
+        self.digest = None
+        self.header = b''
+        self.tail = b''
+
+        # built from the CSV the first time listings are appended
+        self.imputation = None
+        self.values = None
+
+    def current(self):
+        """Return the listings of the CSV as it is now.
+
+        Sessions may call this at the same time. Listings returned earlier
+        are never changed by a refresh.
+        """
+        fingerprint = vehicle_data.file_fingerprint(self.path)
+        with self.lock:
+            if self.listings is None or self.listings.fingerprint != fingerprint:
+                appended = None if self.listings is None else self.read_appended()
+                if appended is None:
+                    self.load(fingerprint)
+                elif appended:
+                    self.append(fingerprint, appended)
+            return self.listings
+
+    def load(self, fingerprint):
+        """Build the listings from the whole CSV."""
+        digest = hashlib.sha256()
+        size = 0
+        header = tail = b''
+        with instrumentation.timed('hash_csv'), open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+                size += len(block)
+                header = header or block.split(b'\n', 1)[0] + b'\n'
+                tail = (tail + block)[-TAIL_BYTES:]
+        data = vehicle_data.load_prepared(self.path, self.snapshot_path, digest.hexdigest())
+        self.listings = Listings(fingerprint, digest.hexdigest(), data)
+        self.size, self.digest, self.header, self.tail = size, digest, header, tail
+        self.imputation = self.values = None
+
+    def read_appended(self):
+        """Return the complete lines appended to the CSV since it was read.
+
+        Returns None when the file was replaced or changed otherwise.
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size <= self.size or not self.tail.endswith(b'\n'):
+                return None
+            f.seek(self.size - len(self.tail))
+            if f.read(len(self.tail)) != self.tail:
+                return None
+            appended = f.read(size - self.size)
+        return appended[:appended.rfind(b'\n') + 1]
+
+    def append(self, fingerprint, appended):
+        """Bring the listings up to date with the `appended` lines of the CSV."""
+        with instrumentation.timed('read_csv'):
+            chunk = pd.read_csv(io.BytesIO(self.header + appended), dtype=vehicle_data.CSV_DTYPES)
+        data = self.listings.data
+        try:
+            if self.imputation is None:
+                with instrumentation.timed('read_imputation_state'):
+                    self.start_imputation(len(data))
+            with instrumentation.timed('impute_appended'):
+                stats, changed = self.imputation.add(chunk, data)
+            for column, found in self.values.items():
+                found.update(chunk[column].cat.categories)
+        except BaseException:
+            # the state may be partly updated; it is read again next time
+            self.imputation = self.values = None
+            raise
+
+        categories = chunked_ingest.file_categories(self.values)
+        cleaned, _ = chunked_ingest.clean_chunk(chunk, stats, categories, vehicle_data.NUMERIC_DTYPES)
+        with instrumentation.timed('combine'):
+            data, rows = combine(data, cleaned, changed)
+
+        self.digest.update(appended)
+        self.size += len(appended)
+        self.tail = (self.tail + appended)[-TAIL_BYTES:]
+        self.listings = self.listings.updated(fingerprint, self.digest.hexdigest(), data, rows)
+
+    def start_imputation(self, rows):
+        """Read the raw values the imputation needs from the first `rows` listings of the CSV."""
+        columns = [imputer.column for imputer in self.imputers]
+        columns += [key for imputer in self.imputers for by in imputer.groupings() for key in by]
+        columns += list(vehicle_data.CSV_DTYPES)
+        prefix = pd.read_csv(self.path, dtype=vehicle_data.CSV_DTYPES, usecols=list(dict.fromkeys(columns)), nrows=rows)
+        self.imputation = ImputationState(self.imputers)
+        self.imputation.add(prefix)
+        self.values = {column: set(prefix[column].cat.categories) for column in vehicle_data.CSV_DTYPES}
@@ -0,0 +1,256 @@
+"""Timings and payload sizes of every rerun of the app.
+
+Streamlit runs app.py again after every click. A Rerun splits that run into
+named sections: calling section(name) ends the section before and starts the
+next one, so the script is timed without changing its layout. Code the
+sections call, such as reading and cleaning the CSV, times its own parts with
+timed(name), and payload(name, obj) records the size of every table or chart
+sent to the browser. All three do nothing outside a rerun, so the modules
+using them still run as plain scripts. counters(name, values) records the
+running totals of a shared object, such as the hits and misses of a cache,
+as they were at the end of the rerun. Work done for a rerun on another
+thread, such as the charts built on a pool, runs inside active(rerun) to be
+recorded with it.
+
+When a rerun finishes it is
+
+- logged as one JSON line on the LOGGER logger,
+- added to a Recorder shared by every session, which keeps the last WINDOW
+  timings of every section for the p50/p95/p99 summary, and
+- optionally drawn with the summary by show_panel, for example in the sidebar.
+
+A rerun stopped before the end, for example by another click, is not recorded.
+"""
+import io
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+LOGGER = logging.getLogger('vehicle_app.timings')
+WINDOW = 1000
+PERCENTILES = [50, 95, 99]
+TOTAL = 'total'
+
+# the rerun of the session whose script runs on this thread
+local = threading.local()
+
+# sizes of the shared figures, which are sent again on every rerun
+sizes = {}
+
+
+def payload_size(obj):
+    """Return the number of bytes `obj` takes on the way to the browser.
+
+    Frames are measured as the Arrow stream st.dataframe sends and charts as
+    their JSON spec. Charts are measured once, as they are shared and never
+    changed.
+    """
+    if isinstance(obj, pd.DataFrame):
+        table = pa.Table.from_pandas(obj)
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.tell()
+
+    key = id(obj)
+    entry = sizes.get(key)
+    if entry is not None and entry[0]() is obj:
+        return entry[1]
+    size = len(obj.to_json().encode())
+    sizes[key] = (weakref.ref(obj, lambda _: sizes.pop(key, None)), size)
+    return size
+
+
+class Rerun:
+    """The section times, part times and payload sizes of one run of the script."""
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder
+        self.wall_time = time.time()
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.sections = {}
+        self.parts = {}
+        self.payloads = {}
+        self.counters = {}
+        self.current = None
+        self.current_start = None
+        # parts and payloads can also be added by threads working for the rerun
+        self.lock = threading.Lock()
+
+    def section(self, name):
+        """End the section running now, if any, and start section `name`."""
+        now = time.perf_counter()
+        if self.current is not None:
+            self.sections[self.current] = self.sections.get(self.current, 0) + now - self.current_start
+        self.current, self.current_start = name, now
+
+    def add_part(self, name, seconds):
+        with self.lock:
+            self.parts[name] = self.parts.get(name, 0) + seconds
+
+    def add_payload(self, name, obj):
+        size = payload_size(obj)
+        with self.lock:
+            self.payloads[name] = self.payloads.get(name, 0) + size
+
+    def add_counters(self, name, values):
+        self.counters[name] = dict(values)
+
+    def finish(self):
+        """End the last section, log the rerun and add it to the recorder."""
+        self.section(None)
+        self.seconds = time.perf_counter() - self.started
+        LOGGER.info(json.dumps(self.record()))
+        if self.recorder is not None:
+            self.recorder.add(self)
+
+    def record(self):
+        """Return the rerun as a dict of plain values."""
+        return {
+            'event': 'rerun',
+            'time': self.wall_time,
+            'seconds': self.seconds,
+            'sections': self.sections,
+            'parts': self.parts,
+            'payload_bytes': self.payloads,
+            'counters': self.counters,
+        }
+
+
+class Recorder:
+    """The last `window` timings of every section and part, shared by all sessions."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.payloads = {}
+
+    def add(self, rerun):
+        with self.lock:
+            for name, seconds in [(TOTAL, rerun.seconds)] + list(rerun.sections.items()) + list(rerun.parts.items()):
+                self.seconds.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            for name, size in rerun.payloads.items():
+                self.payloads.setdefault(name, deque(maxlen=self.window)).append(size)
+
+    def percentiles(self, windows, unit, scale=1):
+        with self.lock:
+            values = {name: np.array(window) for name, window in windows.items()}
+        return pd.DataFrame(
+            [[len(window)] + list(np.percentile(window, PERCENTILES) * scale) for window in values.values()],
+            index=pd.Index(list(values), name='name'),
+            columns=['count'] + ['p{}_{}'.format(p, unit) for p in PERCENTILES],
+        )
+
+    def summary(self):
+        """Return the number of timings and their percentiles in milliseconds, per section or part."""
+        return self.percentiles(self.seconds, 'ms', 1000)
+
+    def payload_summary(self):
+        """Return the number of sizes and their percentiles in bytes, per payload."""
+        return self.percentiles(self.payloads, 'bytes')
+
+
+def start(recorder=None):
+    """Start timing the rerun on this thread and return it."""
+    local.rerun = Rerun(recorder)
+    return local.rerun
+
+
+def finish():
+    """Finish the rerun on this thread, if there is one, and return it."""
+    rerun = getattr(local, 'rerun', None)
+    local.rerun = None
+    if rerun is not None:
+        rerun.finish()
+    return rerun
+
+
+def current():
+    """Return the rerun on this thread, or None."""
+    return getattr(local, 'rerun', None)
+
+
+@contextmanager
+def active(rerun):
+    """Make `rerun` (which may be None) the rerun of this thread for the block.
+
+    A thread working for the rerun of another one, such as a pool thread,
+    runs its work inside active(current()) of the rerun's thread.
+    """
+    previous = current()
+    local.rerun = rerun
+    try:
+        yield
+    finally:
+        local.rerun = previous
+
+
+def section(name):
+    """Start section `name` of the rerun on this thread."""
+    rerun = getattr(local, 'rerun', None)
+    if rerun is not None:
+        rerun.section(name)
+
+
+@contextmanager
+def timed(name):
+    """Time the block as part `name` of the rerun on this thread."""
+    rerun = getattr(local, 'rerun', None)
+    if rerun is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rerun.add_part(name, time.perf_counter() - start)
+
+
+def payload(name, obj):
+    """Record the size of `obj`, a frame or chart sent to the browser as `name`."""
+    rerun = getattr(local, 'rerun', None)
+    if rerun is not None:
+        rerun.add_payload(name, obj)
+
+
+def counters(name, values):
+    """Record `values`, a dict of the counts of `name` (for example a cache), with the rerun on this thread."""
+    rerun = current()
+    if rerun is not None:
+        rerun.add_counters(name, values)
+
+
+def show_panel(container, rerun, recorder):
+    """Draw the timings of `rerun` and the summary of `recorder` in `container` (such as st.sidebar)."""
+    container.header('Timings')
+    container.write('This rerun: {:,.0f} ms'.format(rerun.seconds * 1000))
+    times = pd.Series({**rerun.sections, **rerun.parts}, dtype='float64') * 1000
+    container.dataframe(times.round(1).rename('ms').rename_axis('section').to_frame())
+    if rerun.payloads:
+        container.dataframe(pd.Series(rerun.payloads, dtype='int64').rename('bytes').rename_axis('payload').to_frame())
+    if rerun.counters:
+        container.dataframe(pd.DataFrame(rerun.counters).rename_axis('counter'))
+    container.write('Last {:,} reruns of every session:'.format(recorder.window))
+    container.dataframe(recorder.summary().round(1))
+    container.dataframe(recorder.payload_summary().round(0))
+
+
+def log_to(path=None):
+    """Write the LOGGER lines, one JSON object each, to the file at `path` (or stderr)."""
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
+    return handler
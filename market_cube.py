@@ -0,0 +1,264 @@
+"""Pre-aggregated summary of the listings that the charts and selectors read from.
+
+MarketCube groups the listings once per dataset version into cells, one for
+every combination of the dimensions the page lets users pick from. Each cell
+keeps its listing count, price range, price quartiles and a price histogram
+on a fine grid. Chart data and widget options are then added up from the
+cells, so their cost depends on the number of cells instead of the number of
+listings.
+"""
+import copy
+
+import numpy as np
+import pandas as pd
+
+import charts
+import filter_index
+
+
+DIMENSIONS = ['manufacturer', 'type', 'condition', 'age_category', 'list_age_category', 'new_listing']
+NEW_LISTING_DAYS = 30
+
+# columns of the listings the cube is built from, besides the value
+COLUMNS = DIMENSIONS[:-1] + ['days_listed']
+
+# The price histogram of every cell uses about this many bins over the whole
+# price range. Their width is a power of ten, so every round bin size charts
+# can choose that is at least as wide is made of whole fine bins.
+FINE_BINS = 1000
+
+
+def dimension_labels(data):
+    """Return the values every dimension can take in `data`, in code order."""
+    labels = {name: data[name].cat.categories for name in DIMENSIONS[:-1]}
+    labels['new_listing'] = pd.Index([False, True])
+    return labels
+
+
+def dimension_codes(data):
+    """Return the codes of the DIMENSIONS of every row of `data`, -1 where missing.
+
+    `data` holds the listings, or cells with a boolean new_listing column.
+    """
+    codes = [data[name].cat.codes.to_numpy().astype(np.int64) for name in DIMENSIONS[:-1]]
+    if 'new_listing' in data:
+        codes.append(data['new_listing'].to_numpy().astype(np.int64))
+    else:
+        codes.append((data['days_listed'] <= NEW_LISTING_DAYS).to_numpy().astype(np.int64))
+    return codes
+
+
+def fine_bin_size(values, fine_bins=FINE_BINS):
+    """Return the power of ten closest below the width of `fine_bins` equal bins over `values`."""
+    span = max(values.max() - values.min(), 1) if len(values) else 1
+    return 10.0 ** np.floor(np.log10(span / fine_bins))
+
+
+def histogram_entries(cells, bins):
+    """Return one number for every (cell, fine bin) pair, ordered by cell and then bin."""
+    return cells * 2 ** 32 + (bins + 2 ** 31)
+
+
+def box_groups(data, value, new_only):
+    """Return the listing age code of every row in the box plot of the view, -1 for the others."""
+    groups = data['list_age_category'].cat.codes.to_numpy().astype(np.int64)
+    if new_only:
+        groups[(data['days_listed'] > NEW_LISTING_DAYS).to_numpy()] = -1
+    groups[data[value].isna().to_numpy()] = -1
+    return groups
+
+
+class MarketCube:
+    """Price aggregates of `data` for every combination of DIMENSIONS.
+
+    The listings are also kept ordered by cell and price, and by listing age
+    and price, so the quartiles of a cell or a box plot group are read off by
+    position when listings are added (see `updated`).
+    """
+
+    def __init__(self, data, value='price', fine_bins=FINE_BINS):
+        self.value = value
+        self.fine_bins = fine_bins
+        self.labels = dimension_labels(data)
+        values = data[value].to_numpy()
+        self.bin_size = fine_bin_size(values, fine_bins)
+
+        # the cell and fine histogram bin of every listing
+        self.row_cells = self.cell_keys(data)
+        self.row_bins = self.fine_bins_of(values)
+        self.cell_order = filter_index.GroupOrder(self.row_cells, values)
+        known = self.row_cells >= 0
+        self.hist_entries, self.hist_count = np.unique(
+            histogram_entries(self.row_cells[known], self.row_bins[known]), return_counts=True)
+        numbers = np.unique(self.cell_order.sorted_groups)
+        self.set_cells(self.cell_rows(data, numbers[numbers >= 0]))
+
+        # exact box plot rows for the two views of the page
+        self.box_orders = {new_only: filter_index.GroupOrder(box_groups(data, value, new_only), values) for new_only in (False, True)}
+        self.box = {new_only: self.box_rows(data, new_only) for new_only in (False, True)}
+
+    def fine_bins_of(self, values):
+        return np.floor(values.astype('float64') / self.bin_size).astype(np.int64)
+
+    def cell_keys(self, data):
+        """Return the number of the cell of every row of `data`, -1 where a dimension is missing.
+
+        Cells are numbered in the order of the codes of their dimensions, so
+        sorting by number sorts them like a groupby over DIMENSIONS.
+        """
+        keys = np.zeros(len(data), dtype=np.int64)
+        known = np.ones(len(data), dtype=bool)
+        for name, codes in zip(DIMENSIONS, dimension_codes(data)):
+            keys = keys * len(self.labels[name]) + codes
+            known &= codes >= 0
+        keys[~known] = -1
+        return keys
+
+    def cell_rows(self, data, numbers):
+        """Return the rows of the cells table for the cells `numbers` that have listings."""
+        starts, stops = self.cell_order.bounds(numbers)
+        present = stops > starts
+        stats = charts.sorted_stats(self.cell_order.sorted_values, starts[present], (stops - starts)[present])
+
+        cells = {}
+        remainder = numbers[present]
+        for name in DIMENSIONS[::-1]:
+            size = len(self.labels[name])
+            codes, remainder = remainder % size, remainder // size
+            if name == 'new_listing':
+                cells[name] = codes.astype(bool)
+            else:
+                cells[name] = pd.Categorical.from_codes(codes, dtype=data[name].dtype)
+        return pd.DataFrame({**{name: cells[name] for name in DIMENSIONS}, **stats})
+
+    def set_cells(self, cells):
+        self.cells = cells
+        self.cell_numbers = self.cell_keys(cells)
+
+        # codes of the dimension values of every cell, for fast selection
+        self.codes = {name: codes.astype(np.intp) for name, codes in zip(DIMENSIONS, dimension_codes(cells))}
+
+        # the sparse fine histogram as (cell, bin, count) for every non-empty bin
+        self.hist_cell = np.searchsorted(self.cell_numbers, self.hist_entries // 2 ** 32)
+        self.hist_bin = self.hist_entries % 2 ** 32 - 2 ** 31
+
+    def box_rows(self, data, new_only):
+        """Return the box plot rows of the view, as charts.stats_box_chart draws them."""
+        categories = data['list_age_category'].cat.categories
+        order = self.box_orders[new_only]
+        starts, stops = order.bounds(np.arange(len(categories)))
+        present = stops > starts
+        stats = charts.sorted_stats(order.sorted_values, starts[present], (stops - starts)[present])
+        stats = pd.DataFrame(stats, index=pd.Index(categories[present]).astype(str))
+        return stats.rename_axis('list_age_category').reset_index()
+
+    def updated(self, data, rows):
+        """Return the cube of `data`, the listings this cube was built on with changes.
+
+        `rows` are the positions of the rows added at the end of `data` and of
+        the rows whose values changed. They are placed into the orderings and
+        the histogram, and only the cells they left or joined are summarized
+        again. New dimension values or a new histogram grid build the cube
+        from scratch.
+        """
+        values = data[self.value].to_numpy()
+        labels = dimension_labels(data)
+        if any(not labels[name].equals(self.labels[name]) for name in DIMENSIONS) or fine_bin_size(values, self.fine_bins) != self.bin_size:
+            return MarketCube(data, self.value, self.fine_bins)
+
+        rows = np.unique(np.asarray(rows, dtype=np.intp))
+        added = len(data) - len(self.row_cells)
+        cube = copy.copy(self)
+        cube.row_cells = np.concatenate([self.row_cells, np.full(added, -1, dtype=np.int64)])
+        cube.row_bins = np.concatenate([self.row_bins, np.zeros(added, dtype=np.int64)])
+        left, left_bins = cube.row_cells[rows], cube.row_bins[rows]
+        cube.row_cells[rows] = self.cell_keys(data.iloc[rows])
+        cube.row_bins[rows] = self.fine_bins_of(values[rows])
+        joined, joined_bins = cube.row_cells[rows], cube.row_bins[rows]
+        cube.cell_order = self.cell_order.updated(cube.row_cells, values, rows)
+
+        # the histogram loses the rows from the bins they left and gains them in the bins they joined
+        entries = np.concatenate([
+            histogram_entries(left[left >= 0], left_bins[left >= 0]),
+            histogram_entries(joined[joined >= 0], joined_bins[joined >= 0]),
+        ])
+        changes = np.concatenate([-np.ones((left >= 0).sum(), dtype=np.int64), np.ones((joined >= 0).sum(), dtype=np.int64)])
+        entries, inverse = np.unique(entries, return_inverse=True)
+        changes = np.bincount(inverse, weights=changes, minlength=len(entries)).astype(np.int64)
+        at = np.searchsorted(self.hist_entries, entries)
+        found = at < len(self.hist_entries)
+        found[found] = self.hist_entries[at[found]] == entries[found]
+        counts = self.hist_count.copy()
+        counts[at[found]] += changes[found]
+        hist_entries = np.insert(self.hist_entries, at[~found], entries[~found])
+        counts = np.insert(counts, at[~found], changes[~found])
+        cube.hist_entries, cube.hist_count = hist_entries[counts > 0], counts[counts > 0]
+
+        # summarize the cells the rows left or joined again, and keep the others
+        affected = np.unique(np.concatenate([left, joined]))
+        affected = affected[affected >= 0]
+        cells = pd.concat([self.cells[~np.isin(self.cell_numbers, affected)], cube.cell_rows(data, affected)], ignore_index=True)
+        cube.set_cells(cells.iloc[np.argsort(cube.cell_keys(cells), kind='stable')].reset_index(drop=True))
+
+        cube.box_orders = {
+            new_only: order.updated(box_groups(data, self.value, new_only), values, rows)
+            for new_only, order in self.box_orders.items()
+        }
+        cube.box = {new_only: cube.box_rows(data, new_only) for new_only in (False, True)}
+        return cube
+
+    def select(self, where=None, new_only=False):
+        """Return a mask of the cells matching `where` ({dimension: value}) and the view."""
+        mask = np.ones(len(self.cells), dtype=bool)
+        if new_only:
+            mask &= self.codes['new_listing'] == 1
+        for name, value in (where or {}).items():
+            code = self.labels[name].get_indexer([value])[0]
+            mask &= self.codes[name] == code
+        return mask
+
+    def domain(self, name, where=None, new_only=False):
+        """Return the values of dimension `name` that have listings, in category order."""
+        present = np.unique(self.codes[name][self.select(where, new_only)])
+        return self.labels[name][present]
+
+    def value_range(self, where=None, new_only=False):
+        """Return the lowest and highest value of the matching listings."""
+        cells = self.cells[self.select(where, new_only)]
+        return cells['min'].min(), cells['max'].max()
+
+    def count(self, where=None, new_only=False):
+        """Return the number of matching listings."""
+        return int(self.cells['count'][self.select(where, new_only)].sum())
+
+    def histogram(self, by=None, where=None, new_only=False, nbins=charts.NBINS):
+        """Return the histogram of the matching listings, split by dimension `by`.
+
+        The result is what charts.counts_figure draws: the bin edges, the
+        group labels and a (groups, bins) array of counts. Groups without any
+        listings are left out.
+        """
+        mask = self.select(where, new_only)
+        labels = pd.Index([None]) if by is None else self.labels[by]
+        if not mask.any():
+            return np.array([0.0, 1.0]), labels[:0], np.zeros((0, 1), dtype=np.int64)
+
+        cells = self.cells[mask]
+        low, high = cells['min'].min(), cells['max'].max()
+        ratio = max(1, int(round(charts.nice_bin_size(low, high, nbins) / self.bin_size)))
+        size = ratio * self.bin_size
+        first = int(np.floor(low / self.bin_size)) // ratio
+        count = int(np.floor(high / self.bin_size)) // ratio - first + 1
+
+        entries = mask[self.hist_cell]
+        bins = self.hist_bin[entries] // ratio - first
+        groups = np.zeros(len(bins), dtype=np.intp) if by is None else self.codes[by][self.hist_cell[entries]]
+        counts = np.bincount(groups * count + bins, weights=self.hist_count[entries], minlength=len(labels) * count)
+        counts = counts.astype(np.int64).reshape(len(labels), count)
+
+        used = counts.sum(axis=1) > 0
+        return (first + np.arange(count + 1)) * size, labels[used], counts[used]
+
+    def box_stats(self, new_only=False):
+        """Return the box plot rows of the value by listing age for the view."""
+        return self.box[new_only]
@@ -0,0 +1,115 @@
+"""The charts of a rerun, built at the same time and drawn in page order.
+
+Every chart of the page depends only on widget values drawn above it, and
+building it only reads the shared listings (or asks the query service). With
+a thread pool, PageCharts keeps the place of each chart with st.empty() when
+the script reaches it and builds the chart on the pool; draw() then fills the
+places in page order. A rerun then waits about as long as its slowest chart
+instead of the sum of them, as far as the builds overlap: waiting on the
+query service and most of pandas and numpy release the GIL, making plotly
+objects does not.
+
+The pool is shared by every session, so it also bounds the charts built at
+once. Without a pool the charts are built and drawn one by one where the
+script reaches them. CHART_WORKERS sets the size of the pool; 0, the
+default, builds them one by one. Either way the parts the builds time are
+recorded with the rerun that added the charts.
+"""
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import streamlit as st
+
+import instrumentation
+
+
+WORKERS_VARIABLE = 'CHART_WORKERS'
+
+
+def environment_workers():
+    """Return the number of chart threads in CHART_WORKERS, or 0 when it is not set."""
+    return int(os.environ.get(WORKERS_VARIABLE) or 0)
+
+
+def make_pool(workers):
+    """Return a pool of `workers` threads for PageCharts, or None when `workers` is 0."""
+    return ThreadPoolExecutor(workers, thread_name_prefix='chart') if workers > 0 else None
+
+
+def plotly_chart(container, figure):
+    container.plotly_chart(figure)
+
+
+def altair_chart(container, chart):
+    container.altair_chart(chart, theme='streamlit', use_container_width=True)
+
+
+def prepare(build, rerun=None):
+    """Return `build()`, measured for instrumentation.payload so it is not serialized while the page waits.
+
+    The build runs as part of `rerun` (an instrumentation.Rerun), which is
+    not the rerun of a pool thread.
+    """
+    with instrumentation.active(rerun):
+        chart = build()
+        instrumentation.payload_size(chart)
+    return chart
+
+
+class PageChart:
+    """A chart of the page, drawn by `draw(container, chart)` once built."""
+
+    def __init__(self, name, future, draw, container=None):
+        self.name = name
+        self.future = future
+        self.draw_chart = draw
+        self.container = container
+        self.show_after_drawing = False
+
+    def result(self):
+        """Wait for the chart and return it."""
+        return self.future.result()
+
+    def draw(self, container):
+        chart = self.result()
+        instrumentation.payload(self.name, chart)
+        self.draw_chart(container, chart)
+        if self.show_after_drawing:
+            chart.show()
+
+    def show(self):
+        """Call the show() of the chart (as in the notebook), once it has been drawn."""
+        if self.container is None:
+            self.result().show()
+        else:
+            self.show_after_drawing = True
+
+
+class PageCharts:
+    """The charts of one rerun, built on `pool` (a ThreadPoolExecutor) or, without one, in turn."""
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.waiting = []
+
+    def add(self, name, build, draw):
+        """Start building the chart `name` with `build()` and return its PageChart.
+
+        Without a pool the chart is built and drawn here and now; with one,
+        its place on the page is kept for draw().
+        """
+        if self.pool is None:
+            future = Future()
+            future.set_result(prepare(build, instrumentation.current()))
+            chart = PageChart(name, future, draw)
+            chart.draw(st)
+            return chart
+        chart = PageChart(name, self.pool.submit(prepare, build, instrumentation.current()), draw, st.empty())
+        self.waiting.append(chart)
+        return chart
+
+    def draw(self):
+        """Draw the charts added since the last call, in page order, as each is built."""
+        waiting, self.waiting = self.waiting, []
+        for chart in waiting:
+            chart.draw(chart.container)
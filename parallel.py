@@ -0,0 +1,163 @@
+"""Reading and cleaning the listings on several cores.
+
+vehicle_data.load_vehicles parses and cleans the CSV on one core.
+load_vehicles here does the same work, with the same result, on a pool of
+worker processes and a pool of threads:
+
+- The CSV is cut into byte ranges at line ends and every worker process
+  parses one. The parts are joined in file order with the categories the
+  whole file would have.
+- The group medians of the imputers are computed per key partition: rows
+  are split by a hash of their group key, so every group is whole in one
+  partition, and every worker process aggregates one partition.
+- The steps of vehicle_data.cleaning_steps run on threads as soon as the
+  steps whose columns they use are done, so the manufacturer, the fixed
+  fills, the cylinders fill and the model year fill run at the same time.
+
+Every part is computed exactly as on one core and the results are put
+together in a fixed order, so the cleaned listings are the same whatever the
+number of workers. The CSV must not have line breaks inside quoted values.
+
+Run `python -m parallel [vehicles_us.csv] [workers]` to build the snapshot.
+"""
+import io
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+import vehicle_data
+
+
+def split_points(path, parts):
+    """Return the byte offsets cutting the file at `path` into about `parts` ranges of whole lines."""
+    size = os.path.getsize(path)
+    points = [0]
+    with open(path, 'rb') as f:
+        f.readline()
+        points[0] = f.tell()
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, points[-1]))
+            f.readline()
+            points.append(min(f.tell(), size))
+    points.append(size)
+    return sorted(set(points))
+
+
+def read_range(path, start, stop, dtype=vehicle_data.CSV_DTYPES):
+    """Parse the lines of the CSV at `path` between the byte offsets `start` and `stop`."""
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(start)
+        lines = f.read(stop - start)
+    return pd.read_csv(io.BytesIO(header + lines), dtype=dtype)
+
+
+def read_csv(path, processes, parts):
+    """Return the raw listings of the CSV at `path`, parsed in `parts` ranges on `processes`."""
+    points = split_points(path, parts)
+    frames = list(processes.map(read_range, [path] * (len(points) - 1), points[:-1], points[1:]))
+
+    # the categories read_csv gives the whole file are the sorted values of all parts
+    for column in vehicle_data.CSV_DTYPES:
+        categories = pd.Index(sorted(set().union(*(frame[column].cat.categories for frame in frames))))
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def key_partitions(data, by, parts):
+    """Return the positions of the rows of every partition of the keys `by`, each sorted."""
+    hashes = pd.util.hash_pandas_object(data[by], index=False).to_numpy()
+    partition = hashes % np.uint64(parts)
+    order = np.argsort(partition, kind='stable')
+    bounds = np.searchsorted(partition[order], np.arange(parts + 1, dtype=np.uint64))
+    return [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class PartitionedStats:
+    """The group statistics of `imputer` over `data`, computed per key partition on `processes`.
+
+    Looked up like the precomputed statistics GroupImputer.transform takes.
+    """
+
+    def __init__(self, imputer, data, processes, parts):
+        self.imputer = imputer
+        self.data = data
+        self.processes = processes
+        self.parts = parts
+
+    def __getitem__(self, by):
+        by = list(by)
+        if not by:
+            return self.imputer.group_stats(self.data, by)
+        columns = by + [self.imputer.column]
+        frames = [self.data[columns].iloc[rows] for rows in key_partitions(self.data, by, self.parts)]
+        return pd.concat(list(self.processes.map(self.imputer.group_stats, frames, [by] * len(frames))))
+
+
+def run_steps(data, steps, threads):
+    """Run `steps` (see vehicle_data.cleaning_steps) on `threads` and return `data` with their results.
+
+    A step starts once every earlier step that writes a column it reads or
+    writes, or reads a column it writes, is done. Every step sees the columns
+    as they would be when running the steps one by one, and the results are
+    written in step order.
+    """
+    columns = {name: data[name] for name in data.columns}
+    waits_for = [
+        {i for i, (_, _, reads, writes) in enumerate(steps[:j]) if set(writes) & set(step_reads + step_writes) or set(reads) & set(step_writes)}
+        for j, (_, _, step_reads, step_writes) in enumerate(steps)
+    ]
+    done = set()
+    running = {}
+    while len(done) < len(steps):
+        for j, (_, function, reads, _) in enumerate(steps):
+            if j not in done and j not in running.values() and waits_for[j] <= done:
+                frame = pd.DataFrame({name: columns[name] for name in reads}, copy=False)
+                running[threads.submit(function, frame)] = j
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            columns.update(future.result())
+            done.add(running.pop(future))
+
+    data = data.copy()
+    for _, _, _, writes in steps:
+        for name in writes:
+            data[name] = columns[name]
+    return data
+
+
+def clean_vehicles(data, processes, threads, parts, compact=True):
+    """Clean the raw listings `data` like vehicle_data.clean_vehicles, using both pools."""
+    def stats(imputer, frame):
+        return PartitionedStats(imputer, frame, processes, parts)
+
+    data = run_steps(data, vehicle_data.cleaning_steps(stats), threads)
+    if compact:
+        vehicle_data.apply_schema(data)
+    return data
+
+
+def load_vehicles(path=vehicle_data.DATA_PATH, workers=None, compact=True):
+    """Read and clean the CSV at `path` with `workers` processes (one per core by default)."""
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as processes, ThreadPoolExecutor(workers) as threads:
+        data = read_csv(path, processes, workers)
+        if not compact:
+            # as pd.read_csv without dtypes gives them
+            data = data.astype({column: object for column in vehicle_data.CSV_DTYPES})
+        return clean_vehicles(data, processes, threads, workers, compact)
+
+
+def build_snapshot(path=vehicle_data.DATA_PATH, snapshot_path=vehicle_data.SNAPSHOT_PATH, workers=None):
+    """Clean the CSV at `path` on all cores into the snapshot at `snapshot_path`."""
+    vehicle_data.write_snapshot(load_vehicles(path, workers), vehicle_data.file_hash(path), snapshot_path)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else vehicle_data.DATA_PATH
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    build_snapshot(path, os.path.splitext(path)[0] + '.parquet', workers)
@@ -0,0 +1,317 @@
+"""The queries of the app, answered in the app process or by a shared service.
+
+Every app process normally loads and indexes its own copy of the listings
+(see incremental.py). When QUERY_SERVICE holds the path of a unix socket, the
+app instead sends its queries to a query service listening there, so the
+listings, their indexes and the market cube are held once, however many app
+processes serve the page:
+
+    python -m query_service [vehicles_us.csv] [vehicles_query.sock]
+    QUERY_SERVICE=vehicles_query.sock streamlit run app.py
+
+The page asks for what it shows: the options of its drop downs, pages of the
+listings tables, histograms, box plot rows, scatter plot aggregates and
+comparable listings (the methods in METHODS). LocalQueries answers from the
+listings in memory. QueryClient sends the same calls to the service over a
+pool of connections shared by the sessions of the process, and calls made in
+a batch() go in one round trip.
+
+Requests and answers are pickled by multiprocessing.connection, so the socket
+is created readable by its owner only. With QUERY_SERVICE_KEY set, the
+service and the app also authenticate every connection with that key.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import charts
+import data_viewer
+import incremental
+import market_cube
+import selection
+import vehicle_data
+
+
+SOCKET_PATH = 'vehicles_query.sock'
+ADDRESS_VARIABLE = 'QUERY_SERVICE'
+KEY_VARIABLE = 'QUERY_SERVICE_KEY'
+
+METHODS = {'fingerprint', 'columns', 'sort_columns', 'count', 'table_page', 'domain', 'value_range',
+           'histogram', 'box_stats', 'scatter', 'models', 'comparables'}
+
+# row selections kept for the tables of every version of the listings
+MAX_SELECTIONS = 32
+
+# idle connections a client keeps open
+POOL_SIZE = 8
+
+
+def environment_key():
+    """Return the key in QUERY_SERVICE_KEY, or None when it is not set."""
+    key = os.environ.get(KEY_VARIABLE)
+    return key.encode() if key else None
+
+
+class Pending:
+    """The result of a call in a batch, available once the batch is sent."""
+
+    def __init__(self):
+        self.answer = None
+
+    def result(self):
+        ok, value = self.answer
+        if not ok:
+            raise value
+        return value
+
+
+class Batch:
+    """Calls collected to be answered together when the `with` block ends.
+
+    Calling a query method returns a Pending whose result() is available
+    after the block.
+    """
+
+    def __init__(self, queries):
+        self.queries = queries
+        self.calls = []
+        self.pending = []
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            self.pending.append(Pending())
+            return self.pending[-1]
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            for pending, answer in zip(self.pending, self.queries.run(self.calls)):
+                pending.answer = answer
+
+
+class Queries:
+    def batch(self):
+        """Return a Batch sending the calls made on it in one request."""
+        return Batch(self)
+
+
+class LocalQueries(Queries):
+    """The queries answered from `listings` (see incremental.Listings) in this process."""
+
+    def __init__(self, listings):
+        self.listings = listings
+        self.lock = threading.Lock()
+        self.selections = OrderedDict()
+
+    def run(self, calls):
+        """Answer `calls`, a list of (method name, args, kwargs).
+
+        Returns (True, result) or (False, exception) for every call.
+        """
+        answers = []
+        for name, args, kwargs in calls:
+            try:
+                if name not in METHODS:
+                    raise AttributeError('there is no query {!r}'.format(name))
+                answers.append((True, getattr(self, name)(*args, **kwargs)))
+            except Exception as error:
+                answers.append((False, error))
+        return answers
+
+    def fingerprint(self):
+        return self.listings.fingerprint
+
+    def columns(self):
+        return list(self.listings.data.columns)
+
+    def sort_columns(self):
+        return list(self.listings.sort_index.columns)
+
+    def select(self, new_only=False, equals=None, ranges=None):
+        """Return the sorted positions of the listings matching the filters, or None for all of them.
+
+        `new_only` keeps the listings of the last market_cube.NEW_LISTING_DAYS
+        days; `equals` and `ranges` are as in FilterIndex.query. The last few
+        selections are kept, as a table asks for its size and then a page.
+        """
+        key = (new_only, tuple(sorted((equals or {}).items())), tuple(sorted((ranges or {}).items())))
+        with self.lock:
+            if key in self.selections:
+                self.selections.move_to_end(key)
+                return self.selections[key]
+
+        index = self.listings.index
+        rows = index.query(ranges={'days_listed': (None, market_cube.NEW_LISTING_DAYS)}) if new_only else None
+        if equals or ranges:
+            rows = index.query(equals, ranges, rows)
+        with self.lock:
+            self.selections[key] = rows
+            while len(self.selections) > MAX_SELECTIONS:
+                self.selections.popitem(last=False)
+        return rows
+
+    def count(self, new_only=False, equals=None, ranges=None):
+        """Return the number of listings matching the filters of select."""
+        return selection.count(self.listings.data, self.select(new_only, equals, ranges))
+
+    def table_page(self, new_only=False, equals=None, ranges=None, by=None, descending=False, page=0,
+                   page_size=data_viewer.PAGE_SIZE, columns=None):
+        """Return the `columns` of a page of the listings matching the filters of select (see SortIndex.page)."""
+        rows = self.select(new_only, equals, ranges)
+        positions = self.listings.sort_index.page(rows, by, descending, page, page_size)
+        return selection.take(self.listings.data, positions, columns)
+
+    def domain(self, name, where=None, new_only=False):
+        return self.listings.cube.domain(name, where, new_only)
+
+    def value_range(self, where=None, new_only=False):
+        return self.listings.cube.value_range(where, new_only)
+
+    def histogram(self, by=None, where=None, new_only=False, nbins=charts.NBINS):
+        return self.listings.cube.histogram(by, where, new_only, nbins)
+
+    def box_stats(self, new_only=False):
+        return self.listings.cube.box_stats(new_only)
+
+    def scatter(self, view, x, y, hover_data=()):
+        """Return charts.scatter_aggregate of the rows of `view` (a data_views.View)."""
+        return charts.scatter_aggregate(self.listings.source.read(view), x, y, hover_data)
+
+    def models(self):
+        """Return the models that have comparable listings."""
+        return list(self.listings.comparables.positions)
+
+    def comparables(self, model, model_year, odometer, condition, cylinders, n, columns):
+        """Return the `columns` of the `n` listings most like the vehicle, with their distance."""
+        rows, distances = self.listings.comparables.nearest(model, model_year, odometer, condition, cylinders, n=n)
+        found = selection.take(self.listings.data, rows, columns)
+        found['distance'] = distances.round(3)
+        return found
+
+
+class QueryService:
+    """LocalQueries of the current listings of `feed` (an incremental.ListingFeed).
+
+    The app uses it directly when there is no separate service, and serve
+    answers the requests of app processes with it.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.lock = threading.Lock()
+        self.queries = None
+
+    def current(self):
+        """Return the LocalQueries of the listings as they are now."""
+        listings = self.feed.current()
+        with self.lock:
+            if self.queries is None or self.queries.listings is not listings:
+                self.queries = LocalQueries(listings)
+            return self.queries
+
+    def handle(self, connection):
+        """Answer the requests sent over `connection` until it is closed."""
+        with connection:
+            while True:
+                try:
+                    calls = connection.recv()
+                except (EOFError, OSError):
+                    return
+                connection.send(self.current().run(calls))
+
+
+class QueryClient(Queries):
+    """The queries sent to the service listening on the unix socket `address`.
+
+    Connections are opened as needed and up to `pool_size` idle ones are kept
+    for the next calls, from any thread.
+    """
+
+    def __init__(self, address=SOCKET_PATH, authkey=None, pool_size=POOL_SIZE):
+        self.address = address
+        self.authkey = authkey
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            ok, value = self.run([(name, args, kwargs)])[0]
+            if not ok:
+                raise value
+            return value
+        return call
+
+    def current(self):
+        return self
+
+    def connection(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def run(self, calls):
+        """Send `calls` in one request and return the answers, as LocalQueries.run does."""
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.send(calls)
+                answers = connection.recv()
+            except (EOFError, OSError):
+                # a pooled connection breaks when the service restarts; the queries only read, so they are sent again
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            self.release(connection)
+            return answers
+
+
+def serve(address=SOCKET_PATH, path=vehicle_data.DATA_PATH, snapshot_path=vehicle_data.SNAPSHOT_PATH, authkey=None):
+    """Load the listings of the CSV at `path` and answer queries on the unix socket `address`."""
+    service = QueryService(incremental.ListingFeed(path, snapshot_path))
+    service.current()
+
+    # a socket left by a service that stopped would make the address unusable
+    if os.path.exists(address):
+        os.remove(address)
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    finally:
+        os.umask(umask)
+
+    with listener:
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, OSError):
+                continue
+            threading.Thread(target=service.handle, args=(connection,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else vehicle_data.DATA_PATH
+    address = sys.argv[2] if len(sys.argv) > 2 else SOCKET_PATH
+    serve(os.path.abspath(address), path, os.path.splitext(path)[0] + '.parquet', environment_key())
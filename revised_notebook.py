@@ -3,6 +3,8 @@ import pandas as pd
 import streamlit as st 
 import plotly.express as px 
 
+import vehicle_data
+
 
 
 # %% [markdown]
@@ -40,7 +42,7 @@ data = pd.read_csv('vehicles_us.csv')
 # %%
 # create a new column for manufacturer
 
-data['manufacturer'] = data['model'].apply(lambda x: x.split()[0])
+data['manufacturer'] = vehicle_data.model_manufacturer(data['model'])
 
 
 # %% [markdown]
@@ -259,17 +261,11 @@ st.write("""
 """)
 
 # %%
-# Create age categories of vehicles with a function. 
-
-data['age'] = 2023-data['model_year']
+# Create age categories of vehicles from the AGE_BUCKETS table. 
 
-def age_category(x):
-    if x<5: return 'less than 5 years'
-    elif x>=5 and x<10: return '5-10 years'
-    elif x>= 10 and x<20: return '10-20 years'
-    else: return 'over 20 years'
+data['age'] = vehicle_data.CURRENT_YEAR-data['model_year']
 
-data['age_category']= data['age'].apply(age_category)
+data['age_category'] = vehicle_data.bucketize(data['age'], vehicle_data.AGE_BUCKETS)
 
 
 # %%
@@ -298,7 +294,7 @@ st.plotly_chart(fig2)
 fig2.show()
 
 # %% [markdown]
-# ## Let's say the user wants to look at how the number of days a vehicle has been listed can affect the sales price of the vehicle. To do this we will create categories for days listed with a function called 'list_age_category'. We'll use a box plot as our visual to see how the prices compare based on the listing age. 
+# ## Let's say the user wants to look at how the number of days a vehicle has been listed can affect the sales price of the vehicle. To do this we will create categories for days listed in a column called 'list_age_category'. We'll use a box plot as our visual to see how the prices compare based on the listing age. 
 
 # %% [markdown]
 # # First lets create our web app section header 
@@ -309,19 +305,10 @@ st.write("""
 """) 
 
 # %%
-# Create days listed age group categories using a function.
-
+# Create days listed age group categories from the LIST_AGE_BUCKETS table.
 
-def list_age_category(x):
-    if x<7: return 'less than 7 days'
-    elif x>=7 and x<14: return '7-14 days'
-    elif x>= 14 and x<30: return '14-30 days'
-    elif x>= 30 and x<60: return '30-60 days'
-    elif x>= 60 and x<90: return '60-90 days'
-    elif x>= 90 and  x<180: return '90-180 days'
-    else: return '>180'
 
-data['list_age_category']= data['days_listed'].apply(list_age_category)
+data['list_age_category'] = vehicle_data.bucketize(data['days_listed'], vehicle_data.LIST_AGE_BUCKETS)
 
 
 # %%
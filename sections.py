@@ -0,0 +1,27 @@
+"""Per-session memoization of the sections of the app.
+
+Streamlit runs the whole script again after every widget change. Each section
+of the page declares the inputs (dataset version and widget values) its work
+depends on; when they are the same as on the previous run of the session, the
+result from that run is reused and only the cheap drawing is repeated. A
+widget change therefore only recomputes the sections downstream of it.
+"""
+import streamlit as st
+
+
+STATE_KEY = '_sections'
+
+
+def run(name, inputs, compute):
+    """Return `compute()` for section `name`, reusing the last result if `inputs` are unchanged.
+
+    `inputs` is a tuple of plain values (numbers, strings, tuples) that must
+    compare equal exactly when the result would be the same.
+    """
+    results = st.session_state.setdefault(STATE_KEY, {})
+    previous = results.get(name)
+    if previous is not None and previous[0] == inputs:
+        return previous[1]
+    result = compute()
+    results[name] = (inputs, result)
+    return result
@@ -0,0 +1,25 @@
+"""Row selections over the shared listings frame.
+
+The cleaned listings are loaded once per process and shared by every session,
+so they must never be modified. A session describes what it is looking at as
+an array of row positions into that frame (None meaning every row) and only
+copies out the rows and columns that a table or chart actually needs.
+"""
+
+
+def count(data, rows=None):
+    """Return the number of selected rows."""
+    return len(data) if rows is None else len(rows)
+
+
+def take(data, rows=None, columns=None):
+    """Return the selected rows and columns of `data` as a new frame.
+
+    With neither `rows` nor `columns` this is the shared frame itself, which
+    must not be modified.
+    """
+    if columns is None:
+        return data if rows is None else data.iloc[rows]
+    if rows is None:
+        return data[columns]
+    return data.iloc[rows, data.columns.get_indexer(columns)]
@@ -0,0 +1,299 @@
+"""Loading and cleaning of the vehicles_us.csv listings used by the web app.
+
+Everything here is plain pandas so it can run once per process and be
+shared, instead of being repeated at the top of app.py on every rerun.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import instrumentation
+from imputation import GroupImputer
+
+
+DATA_PATH = 'vehicles_us.csv'
+SNAPSHOT_PATH = 'vehicles_us.parquet'
+
+# Rows per row group of the snapshot. Readers skip the row groups whose
+# statistics rule out their filters (see data_views.py).
+ROW_GROUP_ROWS = 65_536
+
+# Bump this whenever clean_vehicles changes what it produces, so snapshots
+# written by an older version of the pipeline are rebuilt.
+PIPELINE_VERSION = 4
+
+# Compact dtypes of the cleaned listings. Text columns are stored as
+# categoricals, which are read that way straight from the CSV, and numbers are
+# downcast once the missing values have been filled.
+CATEGORY_COLUMNS = ['model', 'condition', 'fuel', 'transmission', 'type', 'paint_color', 'date_posted', 'manufacturer']
+NUMERIC_DTYPES = {
+    'price': 'int32',
+    'model_year': 'int16',
+    'cylinders': 'int16',
+    'odometer': 'float32',
+    'is_4wd': 'bool',
+    'days_listed': 'int16',
+    'age': 'int16',
+}
+CSV_DTYPES = {column: 'category' for column in CATEGORY_COLUMNS if column != 'manufacturer'}
+
+# Age buckets used by the app and the notebook. Each bucket is (upper bound,
+# label) and holds the values from the previous bound up to, but not
+# including, its own bound.
+CURRENT_YEAR = 2023
+AGE_BUCKETS = [
+    (5, 'less than 5 years'),
+    (10, '5-10 years'),
+    (20, '10-20 years'),
+    (np.inf, 'over 20 years'),
+]
+LIST_AGE_BUCKETS = [
+    (7, 'less than 7 days'),
+    (14, '7-14 days'),
+    (30, '14-30 days'),
+    (60, '30-60 days'),
+    (90, '60-90 days'),
+    (180, '90-180 days'),
+    (np.inf, '>180'),
+]
+
+# Missing numbers are filled with the median of similar vehicles. Imputers run
+# in order, so odometer is grouped by the already filled model_year. Groups
+# with no values at all fall back to a coarser group, then the whole column.
+IMPUTERS = [
+    GroupImputer('cylinders', by=['type'], fallback=[[]]),
+    GroupImputer('model_year', by=['model'], fallback=[[]]),
+    GroupImputer('odometer', by=['model_year', 'model'], fallback=[['model'], []]),
+]
+
+
+def file_fingerprint(path=DATA_PATH):
+    """Return a cheap fingerprint of the file at `path`.
+
+    The fingerprint changes whenever the file is replaced or rewritten, so it
+    can be used as a cache key that invalidates itself when the CSV changes.
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def file_hash(path=DATA_PATH):
+    """Return the sha256 hex digest of the contents of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def bucket_labels(buckets):
+    """Return the labels of `buckets` in order."""
+    return [label for _, label in buckets]
+
+
+def bucketize(values, buckets):
+    """Return an ordered categorical placing each of `values` in one of `buckets`."""
+    edges = [-np.inf] + [upper for upper, _ in buckets]
+    return pd.cut(values, edges, right=False, labels=bucket_labels(buckets), ordered=True)
+
+
+def model_manufacturer(model):
+    """Return the manufacturer (first word of the model) for every row.
+
+    The split is only done once per distinct model and mapped back to the rows.
+    """
+    models = pd.Series(model.unique())
+    return model.map(pd.Series(models.str.split().str[0].to_numpy(), index=models))
+
+
+def add_vehicle_age(data):
+    """Return the age and age_category columns for the model years of `data`."""
+    age = CURRENT_YEAR - data['model_year']
+    return {'age': age, 'age_category': bucketize(age, AGE_BUCKETS)}
+
+
+def fill_missing(values, value):
+    """Return `values` with missing entries replaced by `value`.
+
+    Unlike fillna, this also works when `value` is not yet one of the
+    categories of a categorical column.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype) and value not in values.cat.categories:
+        values = values.cat.add_categories([value])
+    return values.fillna(value)
+
+
+def apply_schema(data):
+    """Convert the columns of `data` to the compact dtypes, in place.
+
+    Integer columns holding fractional values (a median between two whole
+    numbers) are kept as float32 rather than being truncated.
+    """
+    for column in CATEGORY_COLUMNS:
+        if column in data and not isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype('category')
+    for column, dtype in NUMERIC_DTYPES.items():
+        if column not in data:
+            continue
+        values = data[column]
+        if np.dtype(dtype).kind == 'i' and not np.array_equal(values, np.round(values)):
+            dtype = 'float32'
+        data[column] = values.astype(dtype)
+    return data
+
+
+def memory_report(before, after):
+    """Return the memory used by every column of `before` and `after`, in bytes."""
+    report = pd.DataFrame({
+        'before': before.memory_usage(index=False, deep=True),
+        'after': after.memory_usage(index=False, deep=True),
+    })
+    report.loc['total'] = report.sum()
+    report['dtype_before'] = before.dtypes.astype(str)
+    report['dtype_after'] = after.dtypes.astype(str)
+    report['saved'] = 1 - report['after'] / report['before']
+    return report
+
+
+def fill_defaults(data):
+    """Fill the missing prices, paint colors and 4wd flags with fixed values."""
+    return {
+        'price': data['price'].fillna(0),
+        'paint_color': fill_missing(data['paint_color'], 'unknown'),
+        'is_4wd': data['is_4wd'].fillna(0),
+    }
+
+
+def imputation_step(imputer, stats=None):
+    """Return the cleaning step filling the column of `imputer`.
+
+    `stats` are the statistics GroupImputer.transform takes, or a function
+    of the imputer and the frame the step sees that returns them.
+    """
+    def fill(data):
+        imputer_stats = stats(imputer, data) if callable(stats) else stats
+        return {imputer.column: imputer.transform(data, imputer_stats)}
+    return fill
+
+
+def cleaning_steps(stats=None, imputers=IMPUTERS):
+    """Return the steps of clean_vehicles in order, as (name, function, columns read, columns written).
+
+    Every function takes a frame holding the columns it reads and returns
+    the new values of the columns it writes, without changing the frame.
+    Steps that do not write what another one reads or writes can run in any
+    order. `stats` are precomputed imputation statistics, as impute takes
+    them, or a function of an imputer and a frame returning its statistics.
+    """
+    steps = [
+        # create a new column for manufacturer
+        ('manufacturer', lambda data: {'manufacturer': model_manufacturer(data['model'])}, ['model'], ['manufacturer']),
+        # fill in missing values using fillna
+        ('fill_defaults', fill_defaults, ['price', 'paint_color', 'is_4wd'], ['price', 'paint_color', 'is_4wd']),
+    ]
+    # fill cylinders, model_year and odometer with group medians
+    for imputer in imputers:
+        imputer_stats = stats if stats is None or callable(stats) else stats[imputer.column]
+        keys = [key for by in imputer.groupings() for key in by]
+        steps.append(('impute_' + imputer.column, imputation_step(imputer, imputer_stats), list(dict.fromkeys([imputer.column] + keys)), [imputer.column]))
+    steps += [
+        # convert model_year column from float to int
+        ('model_year_int', lambda data: {'model_year': data['model_year'].astype(int)}, ['model_year'], ['model_year']),
+        # group vehicle and listing ages into the buckets used by the charts
+        ('vehicle_age', add_vehicle_age, ['model_year'], ['age', 'age_category']),
+        ('list_age', lambda data: {'list_age_category': bucketize(data['days_listed'], LIST_AGE_BUCKETS)}, ['days_listed'], ['list_age_category']),
+    ]
+    return steps
+
+
+def clean_vehicles(data, compact=True, stats=None):
+    """Apply the cleaning steps from the notebook to a raw listings frame.
+
+    With `compact` the result uses the dtypes of apply_schema, otherwise the
+    pandas defaults. `stats` are precomputed imputation statistics for
+    cleaning part of a larger file (see chunked_ingest.py). The steps are
+    listed by cleaning_steps; parallel.py runs the same ones on several cores.
+    """
+    data = data.copy()
+    for name, function, _, _ in cleaning_steps(stats):
+        with instrumentation.timed('clean:' + name):
+            for column, values in function(data).items():
+                data[column] = values
+
+    if compact:
+        with instrumentation.timed('clean:apply_schema'):
+            apply_schema(data)
+    return data
+
+
+def load_vehicles(path=DATA_PATH, compact=True):
+    """Read the raw CSV at `path` and return the cleaned listings."""
+    with instrumentation.timed('read_csv'):
+        data = pd.read_csv(path, dtype=CSV_DTYPES if compact else None)
+    return clean_vehicles(data, compact)
+
+
+def snapshot_tag(source_hash):
+    return {b'source_hash': source_hash.encode(), b'pipeline_version': str(PIPELINE_VERSION).encode()}
+
+
+def snapshot_is_current(source_hash, snapshot_path=SNAPSHOT_PATH):
+    """Return whether there is a snapshot built from `source_hash` by this version of the pipeline."""
+    try:
+        metadata = pq.read_schema(snapshot_path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    return all(metadata.get(key) == value for key, value in snapshot_tag(source_hash).items())
+
+
+def read_snapshot(source_hash, snapshot_path=SNAPSHOT_PATH):
+    """Return the cleaned listings stored at `snapshot_path`.
+
+    Returns None when there is no snapshot, or when it was built from a
+    different source file or by a different version of the pipeline.
+    """
+    if not snapshot_is_current(source_hash, snapshot_path):
+        return None
+    with instrumentation.timed('read_snapshot'):
+        return pq.read_table(snapshot_path).to_pandas()
+
+
+def write_snapshot(data, source_hash, snapshot_path=SNAPSHOT_PATH):
+    """Write the cleaned listings to a Parquet snapshot tagged with `source_hash`."""
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **snapshot_tag(source_hash)})
+
+    # write to a temporary file first so other workers never read a half written snapshot
+    tmp_path = '{}.{}.tmp'.format(snapshot_path, os.getpid())
+    with instrumentation.timed('write_snapshot'):
+        pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_ROWS)
+    os.replace(tmp_path, snapshot_path)
+
+
+def load_prepared(path=DATA_PATH, snapshot_path=SNAPSHOT_PATH, source_hash=None):
+    """Return the cleaned listings, using the snapshot when it is up to date.
+
+    The snapshot is rebuilt from the CSV when it is missing or stale. Failing
+    to write it (for example on a read-only disk) is not an error. Pass
+    `source_hash` when the hash of the CSV is already known.
+    """
+    if source_hash is None:
+        source_hash = file_hash(path)
+    data = read_snapshot(source_hash, snapshot_path)
+    if data is None:
+        data = load_vehicles(path)
+        try:
+            write_snapshot(data, source_hash, snapshot_path)
+        except OSError:
+            pass
+    return data
+
+
+if __name__ == '__main__':
+    # print how much memory the compact dtypes save on the current CSV
+    pd.set_option('display.width', 120)
+    print(memory_report(load_vehicles(compact=False), load_vehicles()))
@@ -0,0 +1,89 @@
+"""Start the app server only once its shared caches are warm.
+
+With `streamlit run app.py` the first visitor of a new process waits for the
+listings to load and be cleaned, the indexes to be built and every chart of
+the default page. This runs app.py once in the process first, with every
+widget at its default value, and then starts the server as `streamlit run`
+does. The caches shared by every session (st.cache_resource) then already
+hold the listings and their indexes (or the connection to the query
+service), the selections of the default tables and the charts of the
+default page: prices by manufacturer, the first vehicle type over the whole
+price range and the first manufacturer and age.
+
+The server only starts listening once the warm-up is done, so its health
+check, /_stcore/health, is also the readiness signal: a load balancer
+probing it never sends a visitor to a cold process. Run from the
+repository root, with any `streamlit run` options:
+
+    python -m warmup --server.port 8501 --server.headless true
+"""
+import logging
+import os
+import runpy
+import sys
+import threading
+import time
+
+from streamlit import config
+from streamlit.runtime.scriptrunner import ScriptRunContext, add_script_run_ctx
+from streamlit.runtime.state import SafeSessionState, SessionState
+from streamlit.runtime.uploaded_file_manager import UploadedFileManager
+from streamlit.web import bootstrap, cli
+
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+LOGGER = logging.getLogger('vehicle_app.warmup')
+
+
+def warm_up(script=APP_PATH):
+    """Run `script` once in this process, as the server runs it for a new visitor, and return the seconds it took.
+
+    Streamlit only caches within a script run, so the script runs on a
+    thread of its own with a run context whose page goes nowhere. Without a
+    browser every widget keeps its default value. The script runs as
+    __main__, as on the server, and the caches are keyed by the module,
+    name and source of the cached functions, so every session of the
+    server finds what this run cached.
+    """
+    context = ScriptRunContext(
+        session_id='warm-up', _enqueue=lambda message: None, query_string='',
+        session_state=SafeSessionState(SessionState()), uploaded_file_mgr=UploadedFileManager(),
+        page_script_hash='', user_info={'email': None})
+    errors = []
+
+    def run():
+        try:
+            runpy.run_path(script, run_name='__main__')
+        except BaseException as error:
+            errors.append(error)
+
+    # the server is not running yet, which Streamlit would warn about
+    config.set_option('global.showWarningOnDirectExecution', False)
+    start = time.perf_counter()
+    thread = add_script_run_ctx(threading.Thread(target=run, name='warm-up'), context)
+    thread.start()
+    thread.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - start
+
+
+def load_config(argv):
+    """Load the Streamlit config with the `streamlit run` options in `argv`, as the server will."""
+    context = cli.main_run.make_context('run', [APP_PATH] + list(argv))
+    bootstrap.load_config_options(flag_options={
+        name: value for name, value in context.params.items() if name not in ('target', 'args')})
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # the warm-up sees the same config as the server, which would otherwise report it changed
+    load_config(argv)
+    LOGGER.info('warmed up in %.1f s, starting the server', warm_up())
+    cli.main(['run', APP_PATH] + list(argv), prog_name='streamlit')
+
+
+if __name__ == '__main__':
+    main()